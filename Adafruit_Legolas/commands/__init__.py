@@ -35,6 +35,6 @@ import os
 # the directory and filters down to just the names (without .py extensions) of
 # python files that don't start with '__' (which are module metadata that should
 # be ignored.
-__all__ = map(lambda x: x[:-3],
+__all__ = list(map(lambda x: x[:-3],
               filter(lambda x: not x.startswith('__') and x.lower().endswith('.py'),
-                     os.listdir(__path__[0])))
+                     os.listdir(__path__[0]))))
@@ -0,0 +1,168 @@
+# ELF symbol diff command.
+#
+# Compare the symbols of two ELF files (like the previous and current release of
+# firmware) and report symbols that were added, removed or changed size.
+#
+# Author: Tony DiCola
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Adafruit Industries
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import concurrent.futures
+import sys
+
+import click
+
+from ..main import main
+from .elfquery import ELFQuery, print_results
+
+
+# Query to pull the symbols to compare out of each ELF file, sorted by the join
+# key.  Undefined symbols and file & section symbols don't take up space so
+# they're ignored.  Symbols without a related section (like absolute or common
+# symbols) use their section index description as the section.  Local symbols
+# with the same name are told apart by their source file (global symbols are
+# matched by name alone, even if their object's file was renamed), and any
+# symbols left with the same name, section and file are added together so
+# they're compared as one.
+DIFF_QUERY = """SELECT Name, IFNULL(Section, SectionIndex) AS Section,
+CASE WHEN Binding = 'LOCAL' THEN IFNULL(File, '') ELSE '' END AS File,
+SUM(Size) AS Size
+FROM symbols
+WHERE Name != '' AND SectionIndex != 'UND' AND Type NOT IN ('FILE', 'SECTION')
+GROUP BY Name, Section, File
+ORDER BY Name, Section, File"""
+
+# Columns of the symbol and section reports.
+SYMBOL_DIFF_COLUMNS = ['Status', 'Name', 'Section', 'File', 'OldSize', 'NewSize', 'Delta']
+SECTION_DIFF_COLUMNS = ['Section', 'OldSize', 'NewSize', 'Delta', 'Added', 'Removed', 'Resized']
+
+
+def load_symbols(input_file):
+    """Load an ELF file and return its list of (name, section, file, size)
+    symbol tuples sorted by name, section and file.  Runs in a worker process
+    so both files are loaded at the same time.
+    """
+    result, columns = ELFQuery(input_file).query(DIFF_QUERY)
+    return result
+
+
+def diff_symbols(old, new, totals):
+    """Merge join two sorted lists of (name, section, file, size) symbol tuples and
+    yield a row for each symbol that was added, removed or resized.  The totals
+    dict is updated with a list of [old size, new size, added, removed, resized]
+    for each section as the lists are joined.
+    """
+    def section_totals(section):
+        if section not in totals:
+            totals[section] = [0, 0, 0, 0, 0]
+        return totals[section]
+    i = 0
+    j = 0
+    while i < len(old) or j < len(new):
+        if j >= len(new) or (i < len(old) and old[i][:3] < new[j][:3]):
+            # Symbol only exists in the old file.
+            name, section, source, size = old[i]
+            counts = section_totals(section)
+            counts[0] += size
+            counts[3] += 1
+            i += 1
+            yield ('removed', name, section, source, size, None, -size)
+        elif i >= len(old) or new[j][:3] < old[i][:3]:
+            # Symbol only exists in the new file.
+            name, section, source, size = new[j]
+            counts = section_totals(section)
+            counts[1] += size
+            counts[2] += 1
+            j += 1
+            yield ('added', name, section, source, None, size, size)
+        else:
+            # Symbol exists in both files, report it if the size changed.
+            name, section, source, old_size = old[i]
+            new_size = new[j][3]
+            counts = section_totals(section)
+            counts[0] += old_size
+            counts[1] += new_size
+            i += 1
+            j += 1
+            if old_size != new_size:
+                counts[4] += 1
+                yield ('resized', name, section, source, old_size, new_size, new_size - old_size)
+
+
+@main.command(short_help='compare the symbols of two ELF files')
+@click.argument('old_file',
+                metavar='OLD_FILE',
+                type=click.Path(exists=True, dir_okay=False))
+@click.argument('new_file',
+                metavar='NEW_FILE',
+                type=click.Path(exists=True, dir_okay=False))
+# Add option to pick between the per-symbol and per-section report.
+@click.option('--report', '-r',
+              type=click.Choice(['symbols', 'sections']),
+              default='symbols',
+              help='report changed symbols (the default) or size totals for each section')
+@click.option('--output-format', '-f',
+              type=click.Choice(['friendly','csv','tsv']),
+              default='friendly',
+              help='format for results (default is friendly human-readable table)')
+@click.option('--output', '-o',
+              type=click.File('w'),
+              default=sys.stdout,
+              help='result file (default is standard output)')
+def elfdiff(old_file, new_file, report, output_format, output):
+    """Compare the symbols of two ELF files.
+
+    Provide the path to the old and new ELF file, for example the previous and
+    current release of firmware:
+
+      legolas elfdiff old.elf new.elf
+
+    Each symbol that was added, removed, or changed size is listed with its old
+    size, new size, and the difference.  Symbols are matched by name, section
+    and source file (for local symbols), and the sizes of symbols that still
+    share all three are added together.  To instead list the total size of
+    symbols in each section along with a count of added, removed and resized
+    symbols use:
+
+      legolas elfdiff old.elf new.elf --report sections
+
+    Like elfquery the results can be written as a friendly table (the default)
+    or as comma or tab separated values with the --output-format option.
+    """
+    # Load both ELF files at the same time in separate processes.
+    with concurrent.futures.ProcessPoolExecutor(max_workers=2) as executor:
+        old_future = executor.submit(load_symbols, old_file)
+        new_future = executor.submit(load_symbols, new_file)
+        old = old_future.result()
+        new = new_future.result()
+    totals = {}
+    rows = diff_symbols(old, new, totals)
+    if report == 'symbols':
+        print_results(rows, SYMBOL_DIFF_COLUMNS, output, output_format)
+    else:
+        # Run through the whole diff to compute the section totals.
+        for row in rows:
+            pass
+        sections = [(section, counts[0], counts[1], counts[1] - counts[0],
+                     counts[2], counts[3], counts[4])
+                    for section, counts in sorted(totals.items())]
+        print_results(sections, SECTION_DIFF_COLUMNS, output, output_format)
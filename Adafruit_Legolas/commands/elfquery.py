@@ -26,19 +26,40 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 import cmd
+import concurrent.futures
+import hashlib
+import math
+import os
+import re
 import sqlite3
+import struct
 import sys
+import time
+import zlib
 
 import click
 from elftools.common.py3compat import bytes2str
 from elftools.elf.elffile import ELFFile
+from elftools.common.exceptions import ELFError
+from elftools.construct import ConstructError
 from elftools.elf.descriptions import *
 from elftools.elf.sections import SymbolTableSection
-from tabulate import tabulate
 
+from ..elfutil import (DEMANGLE_CACHE, DEMANGLER, MappedFile, SymbolDecoder,
+                       demangle, find_objects, section_digests)
 from ..main import main
 
 
+# Errors raised while parsing a malformed (like truncated) ELF file.
+ELF_PARSE_ERRORS = (ELFError, ConstructError, ValueError, struct.error)
+
+
+class ELFQueryOptionError(Exception):
+    """Raised by ELFQuery when its options can't be used together or with the
+    provided input.
+    """
+
+
 # Symbol table column names and types.
 SYMBOL_COLS = [('Number',       'integer primary key autoincrement'),
                ('Value',        'integer'),
@@ -48,10 +69,14 @@ SYMBOL_COLS = [('Number',       'integer primary key autoincrement'),
                ('Visibility',   'text'),
                ('SectionIndex', 'text'),
                ('Name',         'text'),
-               ('Section',      'text')]
+               ('Section',      'text'),
+               ('File',         'text'),
+               ('Archive',      'text'),
+               ('Member',       'text'),
+               ('Demangled',    'text')]
 
 # Section header table column names and types.
-SECTION_COLS = [('Number',    'integer primary key'),
+SECTION_COLS = [('Number',    'integer'),
                 ('Name',      'text'),
                 ('Type',      'text'),
                 ('Flags',     'text'),
@@ -61,7 +86,81 @@ SECTION_COLS = [('Number',    'integer primary key'),
                 ('Link',      'integer'),
                 ('Info',      'integer'),
                 ('Alignment', 'integer'),
-                ('EntrySize', 'integer')]
+                ('EntrySize', 'integer'),
+                ('Archive',   'text'),
+                ('Member',    'text')]
+
+# Program header table column names and types.
+SEGMENT_COLS = [('Number',    'integer'),
+                ('Type',      'text'),
+                ('Offset',    'integer'),
+                ('VirtAddr',  'integer'),
+                ('PhysAddr',  'integer'),
+                ('FileSize',  'integer'),
+                ('MemSize',   'integer'),
+                ('Flags',     'text'),
+                ('Alignment', 'integer')]
+
+# Statements to insert a row into the sections and symbols tables.
+SECTION_INSERT = 'INSERT INTO sections VALUES ({0})'.format(','.join('?'*len(SECTION_COLS)))
+# The symbol number is generated and the demangled name is filled in later.
+SYMBOL_INSERT = 'INSERT INTO symbols ({0}) VALUES ({1})'.format(
+    ', '.join(col[0] for col in SYMBOL_COLS[1:-1]),
+    ','.join('?'*(len(SYMBOL_COLS)-2)))
+
+# Section content view column names and types.  These values are computed
+# from the section contents only when a query uses them.
+SECTION_DATA_COLS = [('Number', 'integer'),
+                     ('Name',   'text'),
+                     ('Crc32',  'integer'),
+                     ('Sha256', 'text'),
+                     ('Data',   'blob'),
+                     ('Archive', 'text'),
+                     ('Member', 'text')]
+
+# Footprint total tables (with the symbols column they group by) and their
+# column names and types.  These are filled in while symbols are loaded so
+# footprint reports don't have to scan and group every symbol.
+TOTALS_TABLES = [('section_totals', 'Section'),
+                 ('type_totals',    'Type'),
+                 ('file_totals',    'File')]
+TOTALS_COLS = [('Symbols', 'integer'),
+               ('Size',    'integer'),
+               ('Archive', 'text'),
+               ('Member',  'text')]
+
+# Column types of the friendly result format, ordered from the least to the most
+# general type.  A column has the most general type of all its values.
+COLUMN_NONE, COLUMN_INT, COLUMN_FLOAT, COLUMN_TEXT = range(4)
+
+# Page cache size (in kilobytes) and memory map size (in bytes) used for a
+# database file.  These bound the memory used while loading huge ELF files.
+DATABASE_CACHE_KB = 256*1024
+DATABASE_MMAP_SIZE = 256*1024*1024
+# Header at the start of every SQLite database file.
+SQLITE_HEADER = b'SQLite format 3\x00'
+
+# Whitespace and comments at the start of a query, and the EXPLAIN keyword
+# that can follow them.
+QUERY_PREFIX = re.compile(r'(?:\s+|--[^\n]*(?:\n|$)|/\*.*?(?:\*/|$))*', re.S)
+EXPLAIN_KEYWORD = re.compile(r'EXPLAIN\b', re.I)
+
+# Default time in seconds between checks of the ELF file for changes in watch
+# mode, and the time a changed file must stay the same before it's reloaded.
+WATCH_INTERVAL_SECONDS = 0.1
+WATCH_SETTLE_SECONDS = 0.05
+
+# Number of SQLite virtual machine instructions between calls of the progress
+# handler that counts them for query statistics (the count is a multiple of
+# it), and the default time in seconds after which a query is logged as slow.
+STATS_PROGRESS_STEPS = 100
+SLOW_QUERY_SECONDS = 1.0
+
+# Columns of the table of query statistics.
+STATS_COLUMNS = ['Number', 'Milliseconds', 'Rows', 'Steps', 'Query']
+
+# Number of rows to buffer before writing them out in the friendly format.
+FRIENDLY_CHUNK_ROWS = 1000
 
 # Example queries that are shown in documentation:
 EXAMPLES = """The following are example queries:
@@ -93,6 +192,22 @@ To select all symbol data for symbols that are of type 'FUNC' or 'OBJECT':
 
   SELECT * FROM symbols WHERE Type IN ('FUNC', 'OBJECT')
 
+C++ symbol names are demangled in the Demangled column, for example to list
+the size of every member function of a class:
+
+  SELECT Demangled, Size FROM symbols WHERE Demangled LIKE 'ns::Widget::%'
+
+The total size of the symbols in each section, of each type and from each
+source file is kept in the section_totals, type_totals and file_totals tables.
+For example to list the sections that take the most space:
+
+  SELECT Section, Size FROM section_totals ORDER BY Size DESC
+
+To list the segments that are loaded into memory, at their load (physical)
+address:
+
+  SELECT Number, TO_HEX(PhysAddr, 8) AS PhysAddr, FileSize, MemSize, Flags FROM segments WHERE Type = 'LOAD'
+
 To select the name and size of the 5 largest symbols:
 
   SELECT Name, Size FROM symbols ORDER BY Size DESC LIMIT 5
@@ -101,6 +216,11 @@ To list all variables in RAM ('.bss' section) sorted by size:
 
   SELECT TO_HEX(Value, 8) AS Value, Size, Section, Name FROM symbols WHERE Section = ".bss" AND Size > 0 ORDER BY Size ASC
 
+To check the CRC32 of the '.text' section (for example to see if code changed
+between two builds):
+
+  SELECT Name, TO_HEX(Crc32, 8) AS Crc32 FROM section_data WHERE Name = '.text'
+
 You can even do more advanced queries like counting how many unique Type
 values exist:
 
@@ -113,19 +233,46 @@ Any query supported by SQLite is possible!
 USAGE = """Query ELF symbols using a SQL-style query.
 
 Provide two arguments, a path to an ELF file and an optional SQL query to 
-make against the file.  The SQL query should be made against the table 
-'symbols' and it contains a row for each symbol.  In addition there is a 
-'sections' table that lists information about each section.  See the
---list-columns option to list all the columns and tables.
+make against the file.  The path can also be a static library (.a archive)
+or a directory which is searched for object files (.o) and archives.  Every
+object is parsed in parallel and loaded into the same tables, with the
+Archive and Member columns telling which object a row came from.
+
+The SQL query should be made against the table 'symbols' and it contains a
+row for each symbol.  In addition there is a 'sections' table that lists
+information about each section, a 'section_data' table with the CRC32,
+SHA-256 and contents of each section, and a 'segments' table that lists the
+program headers (segments) of the ELF file.  The section_totals, type_totals
+and file_totals tables hold the number and total size of the symbols in each
+section, of each type and from each source file.  See the --list-columns
+option to list all the columns and tables.
 
 If no query is provided then an interactive command loop will start where 
 multiple queries can be run successively.
 
+Use - as the path to read the ELF file from standard input, a query must be
+provided then.
+
 Results will be written as a friendly table format to standard output by
 default.  However look at the --output option to write results to a file,
 and the --output-format option to write results in a machine-friendly format
 like a comma or tab separated file.  Note that the output and output format
 options are ignored in interactive query mode.
+
+The database is kept in memory by default.  For very large ELF files use the
+--database option to build it in a file instead, which keeps memory use
+bounded (the file can also be opened later by other SQLite tools).
+
+Use the --stats option to print the time, number of rows, number of SQLite
+virtual machine steps (counted in multiples of 100) and query plan of the
+query, and the --slow-log option to record every query that takes longer than
+the --slow-threshold time (with its query plan) in a log file.  In interactive
+mode the stats command lists these statistics for every query run so far and
+the explain command shows the query plan of a query.
+
+Use the --watch option to keep running and re-run the query every time the
+ELF file changes (like after each rebuild of firmware).  Only the sections and
+symbol tables that changed are loaded again.
 """
 
 
@@ -134,16 +281,110 @@ class ELFQuery(object):
     # example at:
     #   https://github.com/eliben/pyelftools/blob/master/scripts/readelf.py
 
-    def __init__(self, input_file):
-        # Parse ELF file and populate DB table with data.
-        self.elffile = ELFFile(input_file)
+    def __init__(self, input_file, watch=False, database=None, jobs=None,
+                 demangler=DEMANGLER, demangle_cache=DEMANGLE_CACHE, stats=False,
+                 slow_log=None, slow_threshold=SLOW_QUERY_SECONDS):
+        # Remember the input so it can be reloaded when it changes.  In watch
+        # mode a digest of each section is also kept to find what changed.
+        # The input can also be an open binary file object (like stdin).
+        self.input_file = input_file
+        self.watch = watch
+        # The database is kept in memory unless a file for it is provided.
+        self.database = database
+        # Static archives and directories of object files are loaded as a list
+        # of objects (parsed by jobs worker processes), anything else is a
+        # single ELF file.
+        self.jobs = jobs
+        # C++ names are only demangled once a query uses the Demangled column.
+        self.demangler = demangler
+        self.demangle_cache = demangle_cache
+        self.demangled = False
+        # Statistics of each query (number, milliseconds, rows, VM steps and
+        # query) are recorded in stats mode, and queries slower than the
+        # threshold are appended to the slow query log file if there is one.
+        self.stats = stats
+        self.slow_log = slow_log
+        self.slow_threshold = slow_threshold
+        self.statistics = []
+        if hasattr(input_file, 'read'):
+            if watch:
+                raise ELFQueryOptionError('Watch mode needs the path of an ELF file.')
+            self.objects = None
+        else:
+            self.objects = find_objects(input_file)
+        if self.objects is not None and watch:
+            raise ELFQueryOptionError('Watch mode only supports a single ELF file.')
+        self._opened = (None, None)
+        if self.database is not None:
+            self._check_database()
+        if self.objects is None:
+            self._open()
         self._init_db()
-        self._load_db()
+        if self.objects is None:
+            self._load_db()
+        else:
+            self._load_objects()
+        self._finish_load()
+
+    def _open(self):
+        """Memory map and parse the ELF file."""
+        # Memory map the ELF file so pyelftools and the symbol decoder read
+        # from the page cache instead of seeking and reading small chunks.
+        mapped = MappedFile(self.input_file)
+        try:
+            elffile = ELFFile(mapped.stream)
+            digests = section_digests(elffile, mapped) if self.watch else None
+        except:
+            mapped.close()
+            raise
+        self.input = mapped
+        self.elffile = elffile
+        self.digests = digests
+
+    def _check_database(self):
+        """Make sure the database file can be replaced: it can't be the ELF file
+        (or an object file) being loaded, and an existing file must be an
+        SQLite database.  Raises an ELFQueryOptionError if it can't be replaced.
+        """
+        inputs = []
+        if not hasattr(self.input_file, 'read'):
+            inputs.append(self.input_file)
+        if self.objects is not None:
+            inputs.extend(path for archive, member, path, offset, size in self.objects)
+        for path in (self.database, self.database + '-wal', self.database + '-shm'):
+            if not os.path.exists(path):
+                continue
+            for input_path in inputs:
+                if os.path.exists(input_path) and os.path.samefile(path, input_path):
+                    raise ELFQueryOptionError('The database file {0} is an input file!'.format(path))
+        if os.path.exists(self.database):
+            with open(self.database, 'rb') as db_file:
+                header = db_file.read(len(SQLITE_HEADER))
+            # Empty files are fine to replace too, SQLite creates them.
+            if header not in (b'', SQLITE_HEADER):
+                raise ELFQueryOptionError('Not replacing {0}, it is not an SQLite database!'.format(self.database))
 
     def _init_db(self):
-        """Setup the in-memory database for symbol and section data."""
-        # Initialize in memory SQLite DB to hold ELF data.
-        self.db = sqlite3.connect(':memory:')
+        """Setup the database for symbol and section data."""
+        if self.database is None:
+            # Initialize in memory SQLite DB to hold ELF data.
+            self.db = sqlite3.connect(':memory:')
+        else:
+            # Build the DB in a file so memory use stays bounded for huge ELF
+            # files.  Start from an empty file (_check_database made sure an
+            # existing file is a database that's safe to remove) and tune
+            # SQLite for a bulk load that doesn't need to survive a crash: no
+            # rollback journal, no syncing to disk, and a large (but bounded)
+            # page cache.
+            for path in (self.database, self.database + '-wal', self.database + '-shm'):
+                if os.path.exists(path):
+                    os.remove(path)
+            self.db = sqlite3.connect(self.database)
+            self.db.execute('PRAGMA journal_mode = OFF')
+            self.db.execute('PRAGMA synchronous = OFF')
+            self.db.execute('PRAGMA cache_size = -{0}'.format(DATABASE_CACHE_KB))
+            self.db.execute('PRAGMA mmap_size = {0}'.format(DATABASE_MMAP_SIZE))
+            self.db.execute('PRAGMA temp_store = FILE')
         # Add custom functions for hex conversion (although the latest SQLite
         # versions support hex conversions natively, Mac OSX has a very old
         # version of SQLite with Python and needs these functions).
@@ -156,63 +397,604 @@ class ELFQuery(object):
         # Create symbols table.
         column_spec = ', '.join(map(lambda x: '{0} {1}'.format(x[0], x[1]), SYMBOL_COLS))
         self.db.execute("CREATE TABLE symbols ({0})".format(column_spec))
+        # Create segments table.
+        column_spec = ', '.join(map(lambda x: '{0} {1}'.format(x[0], x[1]), SEGMENT_COLS))
+        self.db.execute('CREATE TABLE segments ({0})'.format(column_spec))
+        # Create footprint total tables.
+        for table, column in TOTALS_TABLES:
+            column_spec = ', '.join(map(lambda x: '{0} {1}'.format(x[0], x[1]),
+                                        [(column, 'text')] + TOTALS_COLS))
+            self.db.execute('CREATE TABLE {0} ({1})'.format(table, column_spec))
+        # Create the tables of section checksums and contents, and the section
+        # content view that joins them with the sections.  The tables are only
+        # filled in (and kept in the database) once a query reads them, and
+        # the view is plain SQL so other SQLite tools can use it too.
+        self.db.execute('CREATE TABLE section_hashes (Number integer, Crc32 integer, '
+                        'Sha256 text, Archive text, Member text)')
+        self.db.execute('CREATE TABLE section_contents (Number integer, Data blob, '
+                        'Archive text, Member text)')
+        for table in ('section_hashes', 'section_contents'):
+            self.db.execute('CREATE INDEX {0}_section ON {0} (Number, Archive, Member)'.format(table))
+        self.db.execute('CREATE VIEW section_data AS SELECT s.Number AS Number, '
+                        's.Name AS Name, h.Crc32 AS Crc32, h.Sha256 AS Sha256, '
+                        'c.Data AS Data, s.Archive AS Archive, s.Member AS Member '
+                        'FROM sections s '
+                        'LEFT JOIN section_hashes h ON h.Number = s.Number AND '
+                        'h.Archive IS s.Archive AND h.Member IS s.Member '
+                        'LEFT JOIN section_contents c ON c.Number = s.Number AND '
+                        'c.Archive IS s.Archive AND c.Member IS s.Member')
         self.db.commit()
 
     def _load_db(self):
         """Load symbol and section data into the database."""
-        # Load ELF section metadata.
+        # Load ELF section metadata.  Remember the name of each section by its
+        # index so symbols can be related to their section without a query.
+        self.section_names = {}
+        sections = []
+        for nsec, section in enumerate(self.elffile.iter_sections()):
+            row = section_row(nsec, section)
+            self.section_names[str(nsec)] = row[1]
+            sections.append(row + (None, None))
+        self.db.executemany(SECTION_INSERT, sections)
+        self._load_segments()
+        # Load ELF symbol data into DB, adding up the footprint totals along
+        # the way.
+        self.decoder = SymbolDecoder(self.elffile, self.input)
+        self.symbol_rows = {}
+        self.totals = FootprintTotals()
         for nsec, section in enumerate(self.elffile.iter_sections()):
-            self.db.execute('INSERT INTO sections VALUES (?,?,?,?,?,?,?,?,?,?,?)',
-                            (nsec,
-                             bytes2str(section.name).strip(),
-                             describe_sh_type(section['sh_type']).strip(),
-                             describe_sh_flags(section['sh_flags']).strip(),
-                             section['sh_addr'],
-                             section['sh_offset'],
-                             section['sh_size'],
-                             section['sh_link'],
-                             section['sh_info'],
-                             section['sh_addralign'],
-                             section['sh_entsize']))
-            self.db.commit()
-
-        # Load ELF symbol data into DB.  Adapted from readelf.py.
-        for section in self.elffile.iter_sections():
             if not isinstance(section, SymbolTableSection):
                 continue
             if section['sh_entsize'] == 0:
                 continue
-            for nsym, symbol in enumerate(section.iter_symbols()):
-                # Get the related section header index and name for this symbol.
-                shndx = describe_symbol_shndx(symbol['st_shndx']).strip()
-                related_section = None
-                if str.isdigit(shndx):
-                    sec = self._get_section(shndx)
-                    if sec is not None:
-                        related_section = sec[1]
-                # Write the symbol value to the table.
-                self.db.execute('INSERT INTO symbols VALUES (NULL,?,?,?,?,?,?,?,?)',
-                                (symbol['st_value'],
-                                 symbol['st_size'],
-                                 describe_symbol_type(symbol['st_info']['type']).strip(),
-                                 describe_symbol_bind(symbol['st_info']['bind']).strip(),
-                                 describe_symbol_visibility(symbol['st_other']['visibility']).strip(),
-                                 shndx,
-                                 bytes2str(symbol.name).strip(),
-                                 related_section))
+            self._load_symbols(nsec, section)
+        self.totals.store(self.db)
+        self.db.commit()
+
+    def _load_segments(self):
+        """Replace the segments table with the program headers of the ELF
+        file (there are only a few so they're always loaded again).
+        """
+        self.db.execute('DELETE FROM segments')
+        self.db.executemany('INSERT INTO segments VALUES ({0})'.format(','.join('?'*len(SEGMENT_COLS))),
+                            (segment_row(nseg, segment)
+                             for nseg, segment in enumerate(self.elffile.iter_segments())))
+
+    def _finish_load(self):
+        """Switch a database file from bulk loading to querying.  It's put in
+        WAL mode (so other programs can read it too) and made read-only.
+        """
+        if self.database is None:
+            return
+        self.db.execute('PRAGMA journal_mode = WAL')
+        self.db.execute('PRAGMA synchronous = NORMAL')
+        self.db.execute('PRAGMA query_only = ON')
+
+    def _load_objects(self):
+        """Load the sections and symbols of every object in an archive or
+        directory.  Objects are parsed in parallel by worker processes and
+        their rows are inserted as they come back, in order.
+        """
+        self.object_locations = {}
+        tasks = []
+        for archive, member, path, offset, size in self.objects:
+            self.object_locations[(archive, member)] = (path, offset, size)
+            tasks.append((path, offset, size))
+        totals = FootprintTotals()
+        if self.jobs == 1 or len(tasks) < 2:
+            results = map(decode_object_task, tasks)
+            executor = None
+        else:
+            workers = self.jobs or os.cpu_count() or 1
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+            chunksize = max(1, len(tasks) // (workers*4))
+            results = executor.map(decode_object_task, tasks, chunksize=chunksize)
+        try:
+            for (archive, member, path, offset, size), result in zip(self.objects, results):
+                if not isinstance(result, tuple):
+                    click.echo('WARNING: Skipping {0}, it is not a valid ELF file: {1}'.format(
+                               member if archive is None else '{0}({1})'.format(archive, member),
+                               result), err=True)
+                    continue
+                sections, symbols = result
+                location = (archive, member)
+                self.db.executemany(SECTION_INSERT, (row + location for row in sections))
+                self.db.executemany(SYMBOL_INSERT, totals.add(symbols, archive, member))
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        totals.store(self.db)
+        self.db.commit()
+
+    def _load_symbols(self, nsec, section):
+        """Insert the symbols of a symbol table section and remember the range
+        of symbol numbers they were given so they can be replaced on reload.
+        """
+        first = self._max_symbol_number()
+        symbols = symbol_rows(self.decoder, section, self.section_names,
+                              self.elffile['e_type'] == 'ET_REL')
+        self.db.executemany(SYMBOL_INSERT, self.totals.add(symbols))
+        self.symbol_rows[nsec] = (first, self._max_symbol_number())
+
+    def _max_symbol_number(self):
+        """Return the largest symbol number in use (or 0 if there are none)."""
+        return self.db.execute('SELECT IFNULL(MAX(Number), 0) FROM symbols').fetchone()[0]
+
+    def _open_object(self, archive, member):
+        """Return the ELFFile and MappedFile of an object of an archive or
+        directory (the last opened object is kept open), or of the ELF file if
+        no archive or member is provided.
+        """
+        if self.objects is None:
+            return (self.elffile, self.input)
+        if self._opened[0] != (archive, member):
+            location = self.object_locations.get((archive, member))
+            if location is None:
+                return (None, None)
+            mapped = open_object(*location)
+            self._opened = ((archive, member), (ELFFile(mapped.stream), mapped))
+        return self._opened[1]
+
+    def _section_content(self, number, archive=None, member=None):
+        """Return a memoryview of the contents of the section with the provided
+        number (of an object in an archive or directory), or None if the
+        section has no data in the file.
+        """
+        elffile, mapped = self._open_object(archive, member)
+        if self.watch and file_size(self.input_file) < len(mapped.view):
+            # The file was truncated in place (like while it's being rebuilt),
+            # reading the map (even the section headers) past its end would
+            # crash.
+            return None
+        if elffile is None or number is None or not 0 <= number < elffile.num_sections():
+            return None
+        section = elffile.get_section(number)
+        if section['sh_type'] == 'SHT_NOBITS':
+            return None
+        return mapped.slice(section['sh_offset'], section['sh_size'])
+
+    def _missing_sections(self, table):
+        """Return the (number, archive, member) of every section that has no
+        row in the provided section content table.
+        """
+        return self.db.execute('SELECT Number, Archive, Member FROM sections s WHERE NOT EXISTS '
+                               '(SELECT 1 FROM {0} t WHERE t.Number = s.Number AND '
+                               't.Archive IS s.Archive AND t.Member IS s.Member)'.format(table)).fetchall()
+
+    def _contents_available(self):
+        """Return False if the ELF file was truncated in place (like while it's
+        being rebuilt) so its section contents can't be read right now.
+        """
+        return not (self.watch and file_size(self.input_file) < len(self.input.view))
+
+    def _fill_section_table(self, table, values):
+        """Add a row to a section content table for every section that doesn't
+        have one yet, with the values function computing the row's values from
+        the section's contents (or None for sections without data in the
+        file).
+        """
+        if not self._contents_available():
+            return
+        if self.database is not None:
+            self.db.execute('PRAGMA query_only = OFF')
+        try:
+            for number, archive, member in self._missing_sections(table):
+                content = self._section_content(number, archive, member)
+                row = (number,) + values(content) + (archive, member)
+                if content is not None:
+                    content.release()
+                self.db.execute('INSERT INTO {0} VALUES ({1})'.format(
+                                table, ', '.join('?'*len(row))), row)
+            self.db.commit()
+        finally:
+            self._finish_load()
+
+    def hash_sections(self):
+        """Compute the CRC32 and SHA-256 of the contents of every section that
+        isn't in the section_hashes table yet.
+        """
+        def values(content):
+            if content is None:
+                return (None, None)
+            return (zlib.crc32(content) & 0xFFFFFFFF, hashlib.sha256(content).hexdigest())
+        self._fill_section_table('section_hashes', values)
+
+    def load_section_contents(self):
+        """Copy the contents of every section that isn't in the
+        section_contents table yet into it.
+        """
+        def values(content):
+            return (None if content is None else content.tobytes(),)
+        self._fill_section_table('section_contents', values)
+
+    def _forget_section_contents(self, number=None):
+        """Remove the checksums and contents of a section (or all sections)
+        after it changed.
+        """
+        for table in ('section_hashes', 'section_contents'):
+            if number is None:
+                self.db.execute('DELETE FROM {0}'.format(table))
+            else:
+                self.db.execute('DELETE FROM {0} WHERE Number = ?'.format(table), (number,))
+
+    def reload(self):
+        """Reload the ELF file after it has changed.  Only sections whose
+        header changed are updated and only symbol tables whose contents (or
+        string table) changed are decoded again.  Everything is reloaded if the
+        list of sections changed.  Requires watch mode and returns the number of
+        symbol tables that were decoded again.
+        """
+        # Remember everything a reload changes so it can be put back if the
+        # new file can't be loaded.
+        old_input = self.input
+        old_elffile = self.elffile
+        old_digests = self.digests
+        old_decoder = self.decoder
+        old_symbol_rows = self.symbol_rows
+        old_section_names = self.section_names
+        if self.database is not None:
+            self.db.execute('PRAGMA query_only = OFF')
+        try:
+            self._open()
+            names = [digest[0] for digest in self.digests]
+            if names != [digest[0] for digest in old_digests]:
+                # Sections were added, removed or renamed so start over.
+                self.db.execute('DELETE FROM symbols')
+                self.db.execute('DELETE FROM sections')
+                self._forget_section_contents()
+                self._load_db()
+                reloaded = len(self.symbol_rows)
+            else:
+                reloaded = self._reload_changed(old_digests, old_symbol_rows)
+                self._load_segments()
+                # Only some symbols were replaced so add up the totals again
+                # from the table.
+                rebuild_totals(self.db)
                 self.db.commit()
+        except:
+            # Keep the previous data if the new file can't be loaded.
+            self.db.rollback()
+            if self.input is not old_input:
+                self.input.close()
+            self.input = old_input
+            self.elffile = old_elffile
+            self.digests = old_digests
+            self.decoder = old_decoder
+            self.symbol_rows = old_symbol_rows
+            self.section_names = old_section_names
+            raise
+        finally:
+            self._finish_load()
+        old_input.close()
+        # Demangle the names of reloaded symbols the next time they're used.
+        self.demangled = False
+        return reloaded
 
-    def _get_section(self, index):
-        """Retrieve the specified section row at the provided index."""
-        return self.db.execute('SELECT * FROM sections WHERE Number = ?', (index,)).fetchone()
+    def _reload_changed(self, old_digests, old_symbol_rows):
+        """Update only the sections and symbol tables that changed."""
+        self.decoder = SymbolDecoder(self.elffile, self.input)
+        self.symbol_rows = dict(old_symbol_rows)
+        reloaded = 0
+        for nsec, section in enumerate(self.elffile.iter_sections()):
+            name, header, digest = self.digests[nsec]
+            old_header, old_digest = old_digests[nsec][1:]
+            if digest != old_digest:
+                # Forget the checksums and contents of changed sections.
+                self._forget_section_contents(nsec)
+            if header != old_header:
+                self.db.execute('DELETE FROM sections WHERE Number = ?', (nsec,))
+                self.db.execute(SECTION_INSERT, section_row(nsec, section) + (None, None))
+            if not isinstance(section, SymbolTableSection):
+                continue
+            # Symbols must be decoded again if the symbol table or its string
+            # table changed.
+            link = section['sh_link']
+            if (digest == old_digest and nsec in old_symbol_rows and
+                    link < len(self.digests) and
+                    self.digests[link][2] == old_digests[link][2]):
+                continue
+            if nsec in old_symbol_rows:
+                self.db.execute('DELETE FROM symbols WHERE Number > ? AND Number <= ?',
+                                old_symbol_rows[nsec])
+                del self.symbol_rows[nsec]
+            if section['sh_entsize'] != 0:
+                self._load_symbols(nsec, section)
+            reloaded += 1
+        return reloaded
+
+    def _columns_read(self, query):
+        """Return the set of (table, column) tuples the query reads.  The query
+        is only compiled (with EXPLAIN) and an authorizer callback sees every
+        column it reads, including through views and SELECT *.  A query that
+        is already an EXPLAIN only compiles its statement and reads nothing.
+        """
+        reads = set()
+        if is_explain(query):
+            return reads
+        def authorizer(action, arg1, arg2, database, source):
+            if action == sqlite3.SQLITE_READ:
+                reads.add((arg1, arg2))
+            return sqlite3.SQLITE_OK
+        self.db.set_authorizer(authorizer)
+        try:
+            self.db.execute('EXPLAIN ' + query)
+        finally:
+            self.db.set_authorizer(None)
+        return reads
+
+    def demangle_symbols(self):
+        """Fill in the Demangled column of symbols.  Names are looked up in a
+        persistent cache first (attached as another database) and the rest are
+        demangled in a single batch and added to the cache.  Names which aren't
+        mangled C++ names are copied as is.
+        """
+        if self.database is not None:
+            self.db.execute('PRAGMA query_only = OFF')
+        try:
+            self.db.commit()
+            try:
+                cache_dir = os.path.dirname(self.demangle_cache)
+                if cache_dir and not os.path.isdir(cache_dir):
+                    os.makedirs(cache_dir)
+                self.db.execute('ATTACH DATABASE ? AS demangle_cache', (self.demangle_cache,))
+                self.db.execute('CREATE TABLE IF NOT EXISTS demangle_cache.names '
+                                '(Mangled text primary key, Demangled text)')
+            except (EnvironmentError, sqlite3.Error):
+                # Fall back to a cache that only lasts for this run.
+                self.db.execute('ATTACH DATABASE \':memory:\' AS demangle_cache')
+                self.db.execute('CREATE TABLE demangle_cache.names '
+                                '(Mangled text primary key, Demangled text)')
+            self.db.commit()
+            try:
+                missing = [row[0] for row in self.db.execute(
+                    "SELECT DISTINCT Name FROM symbols WHERE Demangled IS NULL AND "
+                    "Name LIKE '\\_Z%' ESCAPE '\\' AND "
+                    "Name NOT IN (SELECT Mangled FROM demangle_cache.names)")]
+                names = demangle(missing, self.demangler)
+                if names is None:
+                    click.echo('WARNING: Unable to run {0} to demangle symbol names.'.format(self.demangler), err=True)
+                else:
+                    self.db.executemany('INSERT OR REPLACE INTO demangle_cache.names VALUES (?,?)',
+                                        zip(missing, names))
+                self.db.execute('UPDATE symbols SET Demangled = IFNULL((SELECT Demangled FROM '
+                                'demangle_cache.names WHERE Mangled = symbols.Name), Name) '
+                                'WHERE Demangled IS NULL')
+                self.db.commit()
+            finally:
+                self.db.execute('DETACH DATABASE demangle_cache')
+        finally:
+            self._finish_load()
+        self.demangled = True
 
     def query(self, query):
         """Perform SQL query against symbols and return result rows and column
-        names.
+        names.  In stats mode (or with a slow query log) the time, number of
+        rows and number of SQLite VM steps of the query are recorded too.
         """
-        cursor = self.db.execute(query)
+        # Demangle symbol names the first time a query needs them, and fill in
+        # the section checksums and contents a query uses.
+        reads = self._columns_read(query)
+        if not self.demangled and ('symbols', 'Demangled') in reads:
+            self.demangle_symbols()
+        if ('section_hashes', 'Crc32') in reads or ('section_hashes', 'Sha256') in reads:
+            self.hash_sections()
+        if ('section_contents', 'Data') in reads:
+            self.load_section_contents()
+        if not self.stats and self.slow_log is None:
+            cursor = self.db.execute(query)
+            columns = map(lambda x: x[0], cursor.description)
+            return (cursor.fetchall(), columns)
+        # Count VM steps with a progress handler that SQLite calls every
+        # STATS_PROGRESS_STEPS instructions.
+        steps = [0]
+        def progress():
+            steps[0] += STATS_PROGRESS_STEPS
+            return 0
+        self.db.set_progress_handler(progress, STATS_PROGRESS_STEPS)
+        try:
+            # Only time the query itself, not the demangling or hashing above.
+            start = time.time()
+            cursor = self.db.execute(query)
+            result = cursor.fetchall()
+        finally:
+            self.db.set_progress_handler(None, 0)
+        seconds = time.time() - start
+        self.statistics.append((len(self.statistics) + 1, round(seconds*1000, 3),
+                                len(result), steps[0], query))
+        if self.slow_log is not None and seconds >= self.slow_threshold:
+            self._log_slow_query(query, seconds, len(result), steps[0])
         columns = map(lambda x: x[0], cursor.description)
-        return (cursor.fetchall(), columns)
+        return (result, columns)
+
+    def explain(self, query):
+        """Return the query plan of a query as a list of lines, indented to
+        show how the steps of the plan are nested.  An EXPLAIN query has no plan
+        of its own and returns no lines.
+        """
+        depths = {0: -1}
+        lines = []
+        if is_explain(query):
+            return lines
+        for row in self.db.execute('EXPLAIN QUERY PLAN ' + query):
+            node, parent, detail = row[0], row[1], row[-1]
+            depths[node] = depths.get(parent, -1) + 1
+            lines.append('  '*depths[node] + detail)
+        return lines
+
+    def _log_slow_query(self, query, seconds, rows, steps):
+        """Append a slow query with its statistics and query plan to the slow
+        query log file.
+        """
+        try:
+            plan = self.explain(query)
+        except sqlite3.Error as ex:
+            plan = ['(no query plan: {0})'.format(ex)]
+        try:
+            with open(self.slow_log, 'a') as f:
+                f.write('# {0} time: {1:.6f}s rows: {2} steps: {3}\n'.format(
+                        time.strftime('%Y-%m-%d %H:%M:%S'), seconds, rows, steps))
+                f.write(query.strip().rstrip(';') + ';\n')
+                for line in plan:
+                    f.write('-- {0}\n'.format(line))
+        except EnvironmentError as ex:
+            click.echo('WARNING: Failed to write slow query log {0}: {1}'.format(self.slow_log, ex), err=True)
+
+
+def is_explain(query):
+    """Return True if the query is an EXPLAIN or EXPLAIN QUERY PLAN statement
+    (after any leading whitespace and comments).
+    """
+    start = QUERY_PREFIX.match(query).end()
+    return EXPLAIN_KEYWORD.match(query, start) is not None
+
+
+def section_row(nsec, section):
+    """Return the sections table row (without the archive and member columns)
+    for the provided section.
+    """
+    return (nsec,
+            bytes2str(section.name).strip(),
+            describe_sh_type(section['sh_type']).strip(),
+            describe_sh_flags(section['sh_flags']).strip(),
+            section['sh_addr'],
+            section['sh_offset'],
+            section['sh_size'],
+            section['sh_link'],
+            section['sh_info'],
+            section['sh_addralign'],
+            section['sh_entsize'])
+
+
+def segment_row(nseg, segment):
+    """Return the segments table row for the provided program header."""
+    return (nseg,
+            describe_p_type(segment['p_type']).strip(),
+            segment['p_offset'],
+            segment['p_vaddr'],
+            segment['p_paddr'],
+            segment['p_filesz'],
+            segment['p_memsz'],
+            describe_p_flags(segment['p_flags']).strip(),
+            segment['p_align'])
+
+
+# Archive files mapped by this (worker) process, by path.
+_archive_files = {}
+
+
+def symbol_rows(decoder, section, section_names, relocatable=False):
+    """Generate the symbols of a symbol table section as a tuple of symbol
+    values extended with the name of the related section and the source file.
+    The source file of a local symbol is the name of the closest STT_FILE
+    symbol before it.  Global symbols of a relocatable object (like the
+    members of a static library) with a single STT_FILE symbol come from that
+    file, other global symbols have no source file.
+    """
+    source = None
+    sources = set()
+    for symbol in decoder.iter_symbols(section):
+        if symbol[2] == 'FILE':
+            source = symbol[6]
+            sources.add(source)
+        elif symbol[3] != 'LOCAL':
+            # Local symbols come first so every STT_FILE symbol was seen.
+            source = next(iter(sources)) if relocatable and len(sources) == 1 else None
+        yield symbol + (section_names.get(symbol[5]), source)
+
+
+class FootprintTotals(object):
+    """Running count and total size of symbols for each footprint total
+    table, added up while the symbols are loaded.
+    """
+
+    # Position of the size and each grouped column in an inserted symbol row
+    # (which starts after the Number column).
+    SIZE_INDEX = [col[0] for col in SYMBOL_COLS].index('Size') - 1
+    KEY_INDEXES = [[col[0] for col in SYMBOL_COLS].index(column) - 1
+                   for table, column in TOTALS_TABLES]
+
+    def __init__(self):
+        self.totals = [{} for table in TOTALS_TABLES]
+
+    def add(self, symbols, archive=None, member=None):
+        """Generate symbol rows to insert (extended with the archive and
+        member) while adding each symbol to the totals of its object.
+        """
+        size_index = self.SIZE_INDEX
+        groups = list(zip(self.KEY_INDEXES, self.totals))
+        for symbol in symbols:
+            size = symbol[size_index]
+            for index, totals in groups:
+                key = (symbol[index], archive, member)
+                total = totals.get(key)
+                if total is None:
+                    totals[key] = [1, size]
+                else:
+                    total[0] += 1
+                    total[1] += size
+            yield symbol + (archive, member)
+
+    def store(self, db):
+        """Replace the contents of the footprint total tables."""
+        for (table, column), totals in zip(TOTALS_TABLES, self.totals):
+            db.execute('DELETE FROM {0}'.format(table))
+            db.executemany('INSERT INTO {0} VALUES (?,?,?,?,?)'.format(table),
+                           ((key, total[0], total[1], archive, member)
+                            for (key, archive, member), total in totals.items()))
+
+
+def rebuild_totals(db):
+    """Add up the footprint total tables again from the symbols table."""
+    for table, column in TOTALS_TABLES:
+        db.execute('DELETE FROM {0}'.format(table))
+        db.execute('INSERT INTO {0} SELECT {1}, COUNT(*), SUM(Size), Archive, Member '
+                   'FROM symbols GROUP BY {1}, Archive, Member'.format(table, column))
+
+
+def open_object(path, offset, size):
+    """Return a MappedFile for the object file at path, or for the size bytes
+    at offset of an archive.  Archives stay mapped so each member is copied
+    straight out of the mapped archive instead of reading the file again.
+    """
+    if offset == 0 and size is None:
+        return MappedFile(path)
+    if path not in _archive_files:
+        _archive_files[path] = MappedFile(path)
+    return MappedFile(_archive_files[path].slice(offset, size))
+
+
+def decode_object(path, offset, size):
+    """Parse an object file (or archive member) and return a tuple of its
+    section rows and symbol rows (without the archive and member columns).
+    """
+    mapped = open_object(path, offset, size)
+    elffile = ELFFile(mapped.stream)
+    sections = []
+    section_names = {}
+    for nsec, section in enumerate(elffile.iter_sections()):
+        row = section_row(nsec, section)
+        section_names[str(nsec)] = row[1]
+        sections.append(row)
+    decoder = SymbolDecoder(elffile, mapped)
+    symbols = []
+    for section in elffile.iter_sections():
+        if not isinstance(section, SymbolTableSection):
+            continue
+        if section['sh_entsize'] == 0:
+            continue
+        symbols.extend(symbol_rows(decoder, section, section_names,
+                                   elffile['e_type'] == 'ET_REL'))
+    return (sections, symbols)
+
+
+def decode_object_task(task):
+    """Worker process entry point to decode an object, returns the error
+    message instead if the object isn't a valid ELF file.
+    """
+    try:
+        return decode_object(*task)
+    except ELF_PARSE_ERRORS as ex:
+        return str(ex) or type(ex).__name__
 
 
 class InteractiveELFQuery(cmd.Cmd):
@@ -225,6 +1007,8 @@ class InteractiveELFQuery(cmd.Cmd):
         # directly.
         cmd.Cmd.__init__(self)
         self.elfquery = elfquery
+        # Record statistics of every query for the stats command.
+        self.elfquery.stats = True
 
     def do_quit(self, line):
         """Quit the program."""
@@ -242,19 +1026,123 @@ class InteractiveELFQuery(cmd.Cmd):
         """Display example queries."""
         click.echo(EXAMPLES)
 
+    def do_stats(self, line):
+        """List the time, rows and SQLite VM steps of every query run so far.
+        Use 'stats reset' to forget them.
+        """
+        if line.strip() == 'reset':
+            del self.elfquery.statistics[:]
+            return
+        print_results(self.elfquery.statistics, STATS_COLUMNS, sys.stdout, 'friendly')
+        if self.elfquery.statistics:
+            click.echo('Total of {0:.3f} milliseconds and {1} steps.'.format(
+                       sum(row[1] for row in self.elfquery.statistics),
+                       sum(row[3] for row in self.elfquery.statistics)))
+
+    def do_explain(self, query):
+        """Show the query plan of a query, like: explain SELECT * FROM symbols"""
+        try:
+            for line in self.elfquery.explain(query):
+                click.echo(line)
+        except sqlite3.Error as ex:
+            click.echo('ERROR: {0}'.format(ex))
+
     def default(self, query):
         """Run query against ELF file."""
         try:
             result, columns = self.elfquery.query(query)
             print_results(result, columns, sys.stdout, 'friendly')
         except sqlite3.Error as ex:
-            click.echo('ERROR: {0}'.format(ex.message))
+            click.echo('ERROR: {0}'.format(ex))
+
+
+def file_signature(path):
+    """Return a tuple that changes whenever the file at path is modified, or
+    None if the file doesn't exist (like while it's being rebuilt).
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_ino, stat.st_size, stat.st_mtime)
+
+
+def file_size(path):
+    """Return the size of the file at path.  A file that was removed (a map of
+    it stays valid) counts as infinitely large.
+    """
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return float('inf')
+
+
+def wait_for_change(path, interval):
+    """Poll the file at path every interval seconds until it has changed and
+    then stopped changing for WATCH_SETTLE_SECONDS (or the interval if that's
+    shorter) so a file that's still being written by the linker isn't loaded.
+    """
+    settle = min(interval, WATCH_SETTLE_SECONDS)
+    last = file_signature(path)
+    while True:
+        time.sleep(interval)
+        current = file_signature(path)
+        if current is None or current == last:
+            continue
+        # Wait for the file to settle before reporting the change.
+        while True:
+            time.sleep(settle)
+            settled = file_signature(path)
+            if settled is not None and settled == current:
+                return
+            current = settled
+
+
+def watch_query(elfquery, query, output, output_format, interval):
+    """Reload the ELF file and re-run the query each time it changes, until
+    interrupted with Ctrl-C.
+    """
+    click.echo('Watching {0} for changes, press Ctrl-C to quit.'.format(elfquery.input_file), err=True)
+    try:
+        while True:
+            wait_for_change(elfquery.input_file, interval)
+            start = time.time()
+            try:
+                reloaded = elfquery.reload()
+                result, columns = elfquery.query(query)
+            except ELF_PARSE_ERRORS + (EnvironmentError,) as ex:
+                click.echo('ERROR: Failed to reload {0}: {1}'.format(elfquery.input_file, ex), err=True)
+                continue
+            print_results(result, columns, output, output_format)
+            output.flush()
+            if elfquery.stats:
+                print_statistics(elfquery, query)
+            click.echo('Reloaded {0} symbol table(s) and queried in {1:.3f} seconds.'.format(
+                       reloaded, time.time() - start), err=True)
+    except KeyboardInterrupt:
+        pass
+
+
+def print_statistics(elfquery, query):
+    """Print the statistics and query plan of the last query to standard
+    error.
+    """
+    number, milliseconds, rows, steps, query = elfquery.statistics[-1]
+    click.echo('Query took {0:.3f} milliseconds, returned {1} rows and ran {2} SQLite VM steps.'.format(
+               milliseconds, rows, steps), err=True)
+    plan = elfquery.explain(query)
+    if plan:
+        click.echo('Query plan:', err=True)
+    for line in plan:
+        click.echo('  ' + line, err=True)
 
 
 def to_hex(number, width):
     """Convert number to hex value with specified width.  Will be padded by zero
-    to fill the width.
+    to fill the width.  NULL values stay NULL.
     """
+    if number is None:
+        return None
     format_string = '{{0:0{0}X}}'.format(width)
     return format_string.format(number)
 
@@ -277,6 +1165,32 @@ def print_columns():
     click.echo("Table 'symbols' has the following columns:")
     for col in SYMBOL_COLS:
         click.echo('- {0}'.format(col[0]))
+    click.echo('File is the source file of a local symbol (from the STT_FILE symbol before it).')
+    click.echo('Global symbols of an object file (like a static library member) have the')
+    click.echo('source file of the object, global symbols of a linked ELF file have no File.')
+    click.echo('Demangled is the demangled C++ name of the symbol (or the name if it is not')
+    click.echo('a mangled C++ name).')
+    click.echo('')
+    for table, column in TOTALS_TABLES:
+        click.echo("Table '{0}' has the following columns:".format(table))
+        for col in [(column, 'text')] + TOTALS_COLS:
+            click.echo('- {0}'.format(col[0]))
+    click.echo('Symbols is the number of symbols and Size their total size for each {0}.'.format(
+               ', '.join(column for table, column in TOTALS_TABLES)))
+    click.echo('')
+    click.echo("Table 'segments' has the following columns:")
+    for col in SEGMENT_COLS:
+        click.echo('- {0}'.format(col[0]))
+    click.echo('Key to Flags column values: R (read), W (write), E (execute)')
+    click.echo('')
+    click.echo("Table 'section_data' has the following columns:")
+    for col in SECTION_DATA_COLS:
+        click.echo('- {0}'.format(col[0]))
+    click.echo('Crc32 and Sha256 are checksums of the section contents and Data is the')
+    click.echo('raw contents as a blob (use HEX(Data) to print it).  Sections without data')
+    click.echo('in the file (like .bss) have NULL values.  They are computed the first time a')
+    click.echo("query reads them and kept in the 'section_hashes' and 'section_contents'")
+    click.echo('tables (and a --database file) which the view reads from.')
 
 
 def list_columns(ctx, param, value):
@@ -289,12 +1203,117 @@ def list_columns(ctx, param, value):
     ctx.exit()
 
 
+def value_type(value):
+    """Return the friendly format column type of a value.  Like the tabulate
+    module, text that looks like a number is treated as a number and empty
+    text fits any column type.
+    """
+    if value is None or value == '':
+        return COLUMN_NONE
+    if isinstance(value, bool):
+        return COLUMN_TEXT
+    if isinstance(value, int):
+        return COLUMN_INT
+    if isinstance(value, float):
+        return COLUMN_FLOAT
+    try:
+        int(value)
+        return COLUMN_INT
+    except (TypeError, ValueError):
+        pass
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return COLUMN_TEXT
+    # Overflowing values like 1e999 are text unless they're spelled out.
+    if (math.isinf(number) or math.isnan(number)) and value.lower() not in ('inf', '-inf', 'nan'):
+        return COLUMN_TEXT
+    return COLUMN_FLOAT
+
+
+def format_value(value, column_type):
+    """Format a value as text for the friendly format."""
+    if value is None or value == '':
+        return ''
+    if column_type == COLUMN_FLOAT:
+        return format(float(value), 'g')
+    if isinstance(value, bytes) and not isinstance(value, str):
+        try:
+            return value.decode('ascii')
+        except UnicodeDecodeError:
+            return str(value)
+    return str(value).strip()
+
+
+def decimals(text):
+    """Return the number of characters after the decimal point (or exponent) of
+    a formatted number, or -1 if there's no decimal point.
+    """
+    if value_type(text) != COLUMN_FLOAT:
+        return -1
+    position = text.rfind('.')
+    if position < 0:
+        position = text.lower().rfind('e')
+    if position < 0:
+        return -1
+    return len(text) - position - 1
+
+
+def print_friendly(result, columns, output):
+    """Print results as a human-readable table.  This produces the same layout
+    as the tabulate module's 'simple' format: text columns are left aligned and
+    number columns are right aligned (with decimal points lined up), but the
+    column types and widths are computed directly and rows are written in
+    chunks so large results print quickly.
+    """
+    columns = list(columns)
+    # Find the type of each column, once a column has text its values don't
+    # need to be checked any further.
+    types = [COLUMN_NONE]*len(columns)
+    for row in result:
+        for i, value in enumerate(row):
+            if types[i] != COLUMN_TEXT:
+                types[i] = max(types[i], value_type(value))
+    # Format every value and pad each column to its width.  Columns are at least
+    # two characters wider than their header.
+    cells = []
+    headers = []
+    for i, column in enumerate(columns):
+        texts = [format_value(row[i], types[i]) for row in result]
+        numeric = types[i] in (COLUMN_INT, COLUMN_FLOAT) and len(result) > 0
+        if numeric and types[i] == COLUMN_FLOAT:
+            # Line up the decimal points by padding the right side.
+            places = [decimals(text) for text in texts]
+            most = max(places)
+            texts = [text + ' '*(most - count) for text, count in zip(texts, places)]
+        header = str(column)
+        width = max([len(header) + 2] + [len(text) for text in texts])
+        if numeric:
+            texts = [text.rjust(width) for text in texts]
+            headers.append(header.rjust(width))
+        else:
+            texts = [text.ljust(width) for text in texts]
+            headers.append(header.ljust(width))
+        cells.append(texts)
+    output.write('  '.join(headers).rstrip())
+    output.write('\n')
+    output.write('  '.join('-'*len(header) for header in headers).rstrip())
+    # Write the rows in chunks to avoid a write call per row.
+    rows = list(zip(*cells))
+    for start in range(0, len(rows), FRIENDLY_CHUNK_ROWS):
+        chunk = rows[start:start+FRIENDLY_CHUNK_ROWS]
+        output.write('\n')
+        output.write('\n'.join('  '.join(row).rstrip() for row in chunk))
+
+
 def print_results(result, columns, output, output_format):
     """Print out the results of a query to the specified output and using the
-    specified output format.
+    specified output format.  Result can be any iterable of rows, the CSV and
+    TSV formats write each row as soon as it's available.
     """
     if output_format == 'friendly':
-        output.write(tabulate(result, columns))
+        result = list(result)
+        print_friendly(result, columns, output)
         output.write('\n\n')
         output.write('Query returned {0} rows.\n\n'.format(len(result)))
     elif output_format == 'csv':
@@ -310,10 +1329,10 @@ def print_results(result, columns, output, output_format):
 
 
 @main.command(help='{0}\n\n{1}'.format(USAGE, EXAMPLES))
-# Take an ELF file path to query as input.
+# Take an ELF file path to query as input (or - to read it from stdin).
 @click.argument('input_file',
                 metavar='FILE',
-                type=click.File('rb'))
+                type=click.Path(exists=True, allow_dash=True))
 # Also take a string to use as the query.  This is optional and if not provided
 # the program will enter an interactive query mode.
 @click.argument('query',
@@ -339,14 +1358,68 @@ def print_results(result, columns, output, output_format):
               type=click.File('wb'),
               default=sys.stdout,
               help='result file (default is standard output)')
+# Add option to pick how many worker processes parse archives and directories.
+@click.option('--jobs', '-j',
+              type=click.IntRange(1, None),
+              default=None,
+              help='number of worker processes used to parse the objects of an archive or directory (defaults to the number of CPUs)')
+# Add option to pick the program that demangles C++ symbol names.
+@click.option('--demangler',
+              default=DEMANGLER,
+              help='program used to demangle C++ symbol names, like arm-none-eabi-c++filt (defaults to {0})'.format(DEMANGLER))
+# Add option to build the database in a file instead of memory.
+@click.option('--database', '-d',
+              type=click.Path(dir_okay=False),
+              default=None,
+              help='build the database in this file instead of memory (for huge ELF files).  An existing SQLite database file is replaced.')
+# Add options to print query statistics and log slow queries.
+@click.option('--stats',
+              is_flag=True,
+              help='print the time, rows, SQLite VM steps and query plan of the query to standard error')
+@click.option('--slow-log',
+              type=click.Path(dir_okay=False),
+              default=None,
+              help='append queries that take longer than the slow threshold (with their query plan) to this file')
+@click.option('--slow-threshold',
+              type=float,
+              default=SLOW_QUERY_SECONDS,
+              help='seconds after which a query is logged as slow (default is {0})'.format(SLOW_QUERY_SECONDS))
+# Add option to watch the ELF file and re-run the query when it changes.
+@click.option('--watch', '-w',
+              is_flag=True,
+              help='re-run the query every time the ELF file changes')
+@click.option('--interval',
+              type=float,
+              default=WATCH_INTERVAL_SECONDS,
+              help='seconds between checks for changes in watch mode (default is {0})'.format(WATCH_INTERVAL_SECONDS))
 # Define the command code.  Notice how click will send in parsed parameters as
 # arguments to the function.
-def elfquery(input_file, query, output_format, output):
-    elfquery = ELFQuery(input_file)
+def elfquery(input_file, query, output_format, output, jobs, demangler, database,
+             stats, slow_log, slow_threshold, watch, interval):
+    if watch and query is None:
+        raise click.UsageError('A query must be provided in watch mode!')
+    if input_file == '-':
+        # The command loop reads its input from stdin too.
+        if query is None:
+            raise click.UsageError('A query must be provided when the ELF file is read from stdin!')
+        input_file = click.get_binary_stream('stdin')
+    try:
+        elfquery = ELFQuery(input_file, watch=watch, database=database, jobs=jobs,
+                            demangler=demangler, stats=stats, slow_log=slow_log,
+                            slow_threshold=slow_threshold)
+    except ELFQueryOptionError as ex:
+        raise click.UsageError(str(ex))
+    except ELF_PARSE_ERRORS as ex:
+        raise click.ClickException('Unable to load {0}: {1}'.format(
+                                   '-' if hasattr(input_file, 'read') else input_file, ex))
     if query is not None:
         # Query was sent in command line, process it and then exit.
         result, columns = elfquery.query(query)
         print_results(result, columns, output, output_format)
+        if stats:
+            print_statistics(elfquery, query)
+        if watch:
+            watch_query(elfquery, query, output, output_format, interval)
     else:
         # Interactive mode using a command loop.
         click.echo('Interactive query mode.  Enter query at prompt, help for command list, or quit to exit program.')
@@ -30,9 +30,44 @@ import sys
 import click
 import intelhex
 
+from ..hexutil import (HexCache, apply_checksum, cache_options, checksum_options,
+                       merge_segments, merge_start_addr, read_hex, write_hex)
 from ..main import main
 
 
+def merge_hex(images, overlap='error', checksum=None, checksum_start=None,
+              checksum_end=None, checksum_fill=None, checksum_address=None,
+              checksum_endian='little', label=None):
+    """Merge a list of parsed hex files (tuples of segments and start address,
+    like read_hex returns) and optionally compute a checksum of the merged
+    image and write it in.  The label is printed before the checksum.  Returns
+    the merged segments and start address.
+    """
+    segments = []
+    start_addr = None
+    try:
+        for other, other_start_addr in images:
+            segments = merge_segments(segments, other, overlap)
+            start_addr = merge_start_addr(start_addr, other_start_addr, overlap)
+    except intelhex.AddressOverlapError:
+        raise click.ClickException('Detected overlap in address space of merged hex files!')
+    # Compute the checksum of the merged image and write it into the image.
+    if checksum is not None:
+        if not segments:
+            raise click.ClickException('Merged hex file is empty, nothing to checksum!')
+        stamp = apply_checksum(segments,
+                               checksum,
+                               segments[0][0] if checksum_start is None else checksum_start,
+                               segments[-1][0] + len(segments[-1][1]) - 1 if checksum_end is None else checksum_end,
+                               0xFF if checksum_fill is None else checksum_fill,
+                               checksum_address,
+                               checksum_endian,
+                               label)
+        if stamp is not None:
+            segments = merge_segments(segments, [(checksum_address, stamp)], 'replace')
+    return (segments, start_addr)
+
+
 # Definition of the hexmerge command follows below.  First the command is
 # defined using the @main.command decorator.  The short_help is displayed in the
 # help text that lists commands.
@@ -57,10 +92,16 @@ from ..main import main
               type=click.Choice(['error', 'ignore']),
               default='error',
               help='how to handle when hex files overlap.  Can be either error to fail (the default), or ignore to allow the overlap.')
+# Add options to control the cache of parsed input files.
+@cache_options
+# Add options to compute (and optionally write) a checksum of the merged image.
+@checksum_options
 # Define the command code.  Notice how click will send in parsed parameters as
 # arguments to the function.  Also note click will use the docstring as the
 # full help text for the command.
-def hexmerge(inputs, output, overlap):
+def hexmerge(inputs, output, overlap, cache_dir, cache_size, no_cache, checksum,
+             checksum_start, checksum_end, checksum_fill, checksum_address,
+             checksum_endian):
     """Merge Intel format hex files into a single file.
 
     Provide the path to each input file as a separate argument.  For example to
@@ -70,16 +111,32 @@ def hexmerge(inputs, output, overlap):
 
     By default the merged hex file is written to standard output, however see
     the output option below to write to a file.
+
+    Parsed input files are kept in a cache (named by a hash of their contents)
+    so inputs that don't change between runs, like a bootloader, don't have to
+    be parsed again.
+
+    A checksum of the merged image can be computed with the checksum option,
+    where unused addresses are treated as 0xFF bytes (see the checksum fill
+    option).  The checksum can also be written into the merged image, for
+    example to store a CRC16 of 0x1000 - 0x7FFD at 0x7FFE:
+
+      legolas hexmerge boot.hex app.hex --checksum crc16 --checksum-start 0x1000 --checksum-end 0x7FFD --checksum-address 0x7FFE
     """
-    # Process all the input hex files and merge them into a single file.
-    merged = intelhex.IntelHex()
-    try:
-        for filename in inputs:
-            merged.merge(intelhex.IntelHex(filename), overlap)
-    except intelhex.AddressOverlapError:
-        raise click.ClickException('Detected overlap in address space of merged hex files!')
+    # Load all the input hex files (from the cache when possible) and merge
+    # their segments into a single image.
+    cache = None if no_cache else HexCache(cache_dir, cache_size*1024*1024)
+    images = []
+    for filename in inputs:
+        if cache is None:
+            images.append(read_hex(filename))
+        else:
+            images.append(cache.load(filename))
+    segments, start_addr = merge_hex(images, overlap, checksum, checksum_start,
+                                     checksum_end, checksum_fill, checksum_address,
+                                     checksum_endian)
     # Default to stdout if no output file is provided.
     if output is None:
         output = sys.stdout
     # Write out the merged file.
-    merged.write_hex_file(output, True)  # Second param is bool to write start address.
+    write_hex(segments, start_addr, output, True)  # Last param is bool to write start address.
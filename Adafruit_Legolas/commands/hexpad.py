@@ -31,11 +31,83 @@
 import sys
 
 import click
-import intelhex
 
+from ..hexutil import (apply_checksum, checksum_options, iter_padded,
+                       merge_segments, read_hex, write_hex)
 from ..main import main, HexInt
 
 
+def pad_hex(segments, start=None, end=None, pad=0xFF, relative=False, checksum=None,
+            checksum_start=None, checksum_end=None, checksum_fill=None,
+            checksum_address=None, checksum_endian='little', label=None):
+    """Prepare to fill the unused bytes of a parsed hex file (sorted list of
+    segments) from the start to end address (inclusive) with the pad byte, and
+    optionally compute a checksum of the padded image and write it in (the
+    label is printed before the checksum).  Start and end are interpreted like
+    the hexpad command options.  Returns a tuple
+    of the segments (with the checksum written in) and the absolute start and
+    end address to pad, see write_padded to write out the padded image.
+    """
+    if not segments and (start is None or end is None or relative):
+        raise click.ClickException('Input hex file is empty!')
+    # Set start and end value if not specified.
+    if start is None:
+        if relative:
+            # Default to 0 offset in relative mode.
+            start = 0
+        else:
+            # Use the first used address in normal/absolute mode.
+            start = segments[0][0]
+    if end is None:
+        if relative:
+            # Default to 0 offset in relative mode.
+            end = 0
+        else:
+            # Use the last used address in normal/absolute mode.
+            end = segments[-1][0] + len(segments[-1][1]) - 1
+    # Do basic input validation on the start and end values in normal/absolute mode.
+    if not relative:
+        # Fail if either address is negative (bad input value).
+        if start < 0 or end < 0:
+            raise click.ClickException('Start and end address must be positive!')
+        # Also fail if the end address is before the start address.
+        if end < start:
+            raise click.ClickException('End address must be after start address!')
+    # Compute the absolute start and end address in relative mode.
+    if relative:
+        start = segments[0][0] + start
+        end = segments[-1][0] + len(segments[-1][1]) - 1 + end
+    # Compute the checksum of the padded image from the input segments with
+    # unused addresses treated as pad bytes.
+    if checksum is not None:
+        stamp = apply_checksum(segments,
+                               checksum,
+                               start if checksum_start is None else checksum_start,
+                               end if checksum_end is None else checksum_end,
+                               pad if checksum_fill is None else checksum_fill,
+                               checksum_address,
+                               checksum_endian,
+                               label)
+        if stamp is not None:
+            # Padding never replaces data so the checksum can be written into
+            # the input image.
+            segments = merge_segments(segments, [(checksum_address, stamp)], 'replace')
+    return (segments, start, end)
+
+
+def write_padded(segments, start, end, pad, start_addr, output):
+    """Write a hex file with the segments and the unused bytes from the start
+    to end address (inclusive) filled with the pad byte.  The padding is
+    generated as it's written so memory use doesn't depend on the size of the
+    padded range.
+    """
+    max_address = end if end >= start else -1
+    if segments:
+        max_address = max(max_address, segments[-1][0] + len(segments[-1][1]) - 1)
+    write_hex(iter_padded(segments, start, end, pad), start_addr, output, True,
+              max_address)
+
+
 @main.command(short_help='pad unused bytes inside a Intel format hex files')
 @click.argument('input_file',
                 nargs=1,
@@ -64,10 +136,13 @@ from ..main import main, HexInt
               help='enable relative address mode.  The start and end address value ' \
                    'will be interpreted as an offset relative to the min and max address ' \
                    'of the input file.  Negative values are allowed.')
+# Add options to compute (and optionally write) a checksum of the padded image.
+@checksum_options
 # Define the command code.  Notice how click will send in parsed parameters as
 # arguments to the function.  Also note click will use the docstring as the
 # full help text for the command.
-def hexpad(input_file, output, start, end, pad, relative):
+def hexpad(input_file, output, start, end, pad, relative, checksum, checksum_start,
+           checksum_end, checksum_fill, checksum_address, checksum_endian):
     """Pad unused bytes of Intel format hex.
 
     Given a hex file this command will fill in any unused bytes with a padding
@@ -104,44 +179,22 @@ def hexpad(input_file, output, start, end, pad, relative):
     If either the start or end value are not specified in relative mode then a
     relative offset of 0 will be used (i.e. the range will span the first/last
     used address in the input).
+
+    A checksum of the padded image can be computed with the checksum option
+    and optionally written into the output image.  For example to compute a
+    CRC32 of the padded range and store it (little endian) right after it:
+
+      legolas hexpad input_file.hex --end 0x1FFFB --checksum crc32 --checksum-address 0x1FFFC
+
+    By default the checksum covers the padded range, use the checksum start and
+    end options to pick a different range.
     """
-    input_hex = intelhex.IntelHex(input_file)
-    padded = intelhex.IntelHex()
-    # Set start and end value if not specified.
-    if start is None:
-        if relative:
-            # Default to 0 offset in relative mode.
-            start = 0
-        else:
-            # Use the first used address in normal/absolute mode.
-            start = input_hex.minaddr()
-    if end is None:
-        if relative:
-            # Default to 0 offset in relative mode.
-            end = 0
-        else:
-            # Use the last used address in normal/absolute mode.
-            end = input_hex.maxaddr()
-    # Do basic input validation on the start and end values in normal/absolute mode.
-    if not relative:
-        # Fail if either address is negative (bad input value).
-        if start < 0 or end < 0:
-            raise click.ClickException('Start and end address must be positive!')
-        # Also fail if the end address is before the start address.
-        if end < start:
-            raise click.ClickException('End address must be after start address!')
-    # Compute the absolute start and end address in relative mode.
-    if relative:
-        start = input_hex.minaddr() + start
-        end = input_hex.maxaddr() + end
-    # Fill the padded file address range with the pad byte.
-    for i in range(start, end+1):  # Use end+1 to make sure last address is padded.
-        padded[i] = pad & 0xFF
-    # Now merge in the input file on top of the pad bytes, this will make the
-    # unused bytes have the pad byte.
-    padded.merge(input_hex, overlap='replace')
+    input_segments, start_addr = read_hex(input_file)
+    segments, start, end = pad_hex(input_segments, start, end, pad, relative, checksum,
+                                   checksum_start, checksum_end, checksum_fill,
+                                   checksum_address, checksum_endian)
     # Default to stdout if no output file is provided.
     if output is None:
         output = sys.stdout
-    # Write out the padded file.
-    padded.write_hex_file(output, True)  # Second param is bool to write start address.
+    # Write out the padded file, the padding is generated as it's written.
+    write_padded(segments, start, end, pad, start_addr, output)
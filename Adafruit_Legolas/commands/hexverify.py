@@ -0,0 +1,120 @@
+# Hex file verification command.
+#
+# Check that an Intel .hex file holds exactly the loadable contents of the ELF
+# file it was built from.
+#
+# Author: Tony DiCola
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Adafruit Industries
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import sys
+
+import click
+from elftools.common.exceptions import ELFError
+from elftools.elf.elffile import ELFFile
+
+from ..elfutil import MappedFile, load_segments
+from ..hexutil import (HexCache, cache_options, compare_segments, merge_segments,
+                       read_hex)
+from ..main import main
+from .elfquery import print_results
+
+
+# Columns of the report of mismatched ranges.
+VERIFY_COLUMNS = ['Start', 'End', 'Size', 'Kind', 'Segment']
+
+
+@main.command(short_help='verify a hex file against the ELF file it was built from')
+# Take the ELF and hex file paths as input.
+@click.argument('elf_file',
+                metavar='ELF',
+                type=click.Path(exists=True, dir_okay=False))
+@click.argument('hex_file',
+                metavar='HEX',
+                type=click.Path(exists=True, dir_okay=False))
+# Add option to compare at the virtual instead of the physical address.
+@click.option('--virtual',
+              is_flag=True,
+              help='compare segments at their virtual address instead of their physical (load) address')
+# Add option to also fail when the hex file has data the ELF file doesn't load.
+@click.option('--strict',
+              is_flag=True,
+              help='also report data in the hex file that is outside every loaded segment')
+# Add options to control the report format and output.
+@click.option('--output-format', '-f',
+              type=click.Choice(['friendly', 'csv', 'tsv']),
+              default='friendly',
+              help='format for the report (default is friendly human-readable table)')
+@click.option('--output', '-o',
+              type=click.File('w'),
+              default=sys.stdout,
+              help='report file (default is standard output)')
+# Add options to control the cache of parsed hex files.
+@cache_options
+def hexverify(elf_file, hex_file, virtual, strict, output_format, output,
+              cache_dir, cache_size, no_cache):
+    """Verify a hex file against the ELF file it was built from.
+
+    The contents of each loadable (PT_LOAD) segment of the ELF file are compared
+    with the data of the hex file at the segment's physical (load) address.
+    Like objcopy does when it converts an ELF file to a hex file only the
+    allocated sections in a segment are compared.  For example:
+
+      legolas hexverify firmware.elf firmware.hex
+
+    Only ranges of addresses that don't match are reported, either because the
+    data differs or because it is missing from the hex file.  With the strict
+    option data in the hex file outside of every segment (like a bootloader
+    merged in with hexmerge) is reported too.  The command exits with a
+    non-zero status if anything was reported.
+    """
+    # Load the contents of the ELF file's segments as memoryviews of the mapped
+    # file, and the hex file (from the cache when possible).
+    try:
+        mapped = MappedFile(elf_file)
+        loaded = load_segments(ELFFile(mapped.stream), mapped, physical=not virtual)
+    except ELFError as ex:
+        raise click.ClickException('Failed to read ELF file: {0}'.format(ex))
+    expected = merge_segments([], [(address, data) for nseg, address, data in loaded], 'replace')
+    if no_cache:
+        actual, start_addr = read_hex(hex_file)
+    else:
+        actual, start_addr = HexCache(cache_dir, cache_size*1024*1024).load(hex_file)
+    # Compare the images and report the ranges that don't match, along with
+    # the segment they belong to.
+    rows = []
+    for start, end, kind in compare_segments(expected, actual):
+        if kind == 'extra' and not strict:
+            continue
+        segment = None
+        for nseg, address, data in loaded:
+            if address <= start < address + len(data):
+                segment = nseg
+        rows.append(('0x{0:08X}'.format(start), '0x{0:08X}'.format(end - 1),
+                     end - start, kind, segment))
+    if rows:
+        print_results(rows, VERIFY_COLUMNS, output, output_format)
+        click.echo('{0} does not match {1}: {2} mismatched range(s) of {3} byte(s).'.format(
+                   hex_file, elf_file, len(rows), sum(row[2] for row in rows)), err=True)
+        sys.exit(1)
+    click.echo('{0} matches the {1} loaded segment(s) of {2}.'.format(
+               hex_file, len(set(nseg for nseg, address, data in loaded)), elf_file), err=True)
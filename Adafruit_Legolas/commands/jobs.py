@@ -0,0 +1,364 @@
+# Job runner command.
+#
+# Run many hexmerge, hexpad and elfquery jobs described by a manifest file (like
+# the jobs of every board target in a build) concurrently in one process.
+#
+# Author: Tony DiCola
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Adafruit Industries
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import asyncio
+import concurrent.futures
+import json
+import os
+import time
+
+import click
+
+from ..hexutil import (CACHE_SIZE, HexCache, cache_options, iter_padded, read_hex,
+                       write_hex)
+from ..main import main
+from .elfquery import ELFQuery, print_results
+from .hexmerge import merge_hex
+from .hexpad import pad_hex, write_padded
+
+# YAML manifests are optional and need the PyYAML module.
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+
+# Checksum options shared by the hex jobs.
+CHECKSUM_OPTIONS = ('checksum', 'checksum_start', 'checksum_end', 'checksum_fill',
+                    'checksum_address', 'checksum_endian')
+
+# Options each kind of job takes (besides its name and command).  These are
+# named like the command's options, with dashes or underscores.
+JOB_OPTIONS = {
+    'hexmerge': ('inputs', 'output', 'overlap') + CHECKSUM_OPTIONS,
+    'hexpad':   ('input', 'output', 'start', 'end', 'pad', 'relative') + CHECKSUM_OPTIONS,
+    'elfquery': ('input', 'query', 'output', 'output_format')
+}
+
+# Options that are addresses or bytes and can be written as hex strings (like
+# '0x1000') since JSON has no hex numbers.
+ADDRESS_OPTIONS = ('start', 'end', 'pad', 'checksum_start', 'checksum_end',
+                   'checksum_fill', 'checksum_address')
+
+
+def load_manifest(manifest):
+    """Read a JSON or YAML (by file extension) manifest and return its list of
+    jobs as dicts of options.  Paths are relative to the manifest's directory
+    and a job's input can be the output of an earlier hex job.
+    """
+    with open(manifest, 'r') as f:
+        if manifest.lower().endswith(('.yaml', '.yml')):
+            if yaml is None:
+                raise click.ClickException('The PyYAML module is required to read YAML manifests!')
+            data = yaml.safe_load(f)
+        else:
+            data = json.load(f)
+    if isinstance(data, dict):
+        data = data.get('jobs')
+    if not isinstance(data, list):
+        raise click.ClickException('Manifest must have a list of jobs!')
+    base = os.path.dirname(os.path.abspath(manifest))
+    jobs = []
+    for number, entry in enumerate(data, 1):
+        if not isinstance(entry, dict):
+            raise click.ClickException('Job {0} must be a mapping of options!'.format(number))
+        job = dict((key.replace('-', '_'), value) for key, value in entry.items())
+        name = str(job.pop('name', 'job {0}'.format(number)))
+        command = job.pop('command', None)
+        if command not in JOB_OPTIONS:
+            raise click.ClickException('{0}: command must be one of {1}!'.format(
+                                       name, ', '.join(sorted(JOB_OPTIONS))))
+        unknown = set(job) - set(JOB_OPTIONS[command])
+        if unknown:
+            raise click.ClickException('{0}: unknown option(s) {1}!'.format(
+                                       name, ', '.join(sorted(unknown))))
+        if 'output' not in job:
+            raise click.ClickException('{0}: an output file is required!'.format(name))
+        if command == 'hexmerge':
+            if not isinstance(job.get('inputs'), list):
+                raise click.ClickException('{0}: a list of inputs is required!'.format(name))
+            job['inputs'] = [os.path.join(base, str(path)) for path in job['inputs']]
+        else:
+            if 'input' not in job:
+                raise click.ClickException('{0}: an input file is required!'.format(name))
+            job['input'] = os.path.join(base, str(job['input']))
+        if command == 'elfquery' and 'query' not in job:
+            raise click.ClickException('{0}: a query is required!'.format(name))
+        job['output'] = os.path.join(base, str(job['output']))
+        for key in ADDRESS_OPTIONS:
+            if isinstance(job.get(key), str):
+                try:
+                    job[key] = int(job[key], 0)
+                except ValueError:
+                    raise click.ClickException('{0}: {1} is not a valid integer!'.format(name, key))
+        job['name'] = name
+        job['command'] = command
+        jobs.append(job)
+    return jobs
+
+
+def parse_hex(filename, cache_dir, cache_size):
+    """Worker process entry point to parse a hex file (through the cache if a
+    directory for it is provided).  The segments are returned as bytes so
+    they can be sent back to the main process.
+    """
+    if cache_dir is None:
+        return read_hex(filename)
+    segments, start_addr = HexCache(cache_dir, cache_size).load(filename)
+    return ([(start, memoryview(data).tobytes()) for start, data in segments], start_addr)
+
+
+def write_hex_file(filename, segments, start_addr, padding=None):
+    """Write a hex file, creating its directory if needed.  Padding is None or
+    a tuple of the start address, end address and pad byte to pad the segments
+    with as they're written.
+    """
+    directory = os.path.dirname(filename)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(filename, 'w') as output:
+        if padding is None:
+            write_hex(segments, start_addr, output, True)
+        else:
+            write_padded(segments, padding[0], padding[1], padding[2], start_addr, output)
+
+
+def build_hex_file(job, images, keep_image):
+    """Worker process entry point to build the image of a hexmerge or hexpad
+    job from its parsed input images and write its output file.  The image is
+    returned as bytes if keep_image is true (a later job uses it), or else
+    None.
+    """
+    options = dict((key, job[key]) for key in CHECKSUM_OPTIONS if key in job)
+    padding = None
+    if job['command'] == 'hexmerge':
+        segments, start_addr = merge_hex(images, job.get('overlap', 'error'),
+                                         label=job['name'], **options)
+    else:
+        segments, start_addr = images[0]
+        for key in ('start', 'end', 'pad', 'relative'):
+            if key in job:
+                options[key] = job[key]
+        segments, pad_start, pad_end = pad_hex(segments, label=job['name'], **options)
+        padding = (pad_start, pad_end, job.get('pad', 0xFF))
+    # The padding of a hexpad job is generated as it's written.
+    write_hex_file(job['output'], segments, start_addr, padding)
+    if not keep_image:
+        return None
+    # Only build the padded image in memory if a later job uses it.
+    if padding is not None:
+        segments = iter_padded(segments, *padding)
+    return ([(address, memoryview(data).tobytes()) for address, data in segments], start_addr)
+
+
+def run_queries(input_file, queries):
+    """Worker process entry point to load an ELF file once and run each of a
+    list of (query, output file, output format) on it.  Returns a list with
+    the number of result rows of each query, or the error message if it
+    failed.
+    """
+    try:
+        elfquery = ELFQuery(input_file)
+    except Exception as ex:
+        return [str(ex)] * len(queries)
+    results = []
+    for query, output, output_format in queries:
+        try:
+            result, columns = elfquery.query(query)
+            directory = os.path.dirname(output)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(output, 'w') as f:
+                print_results(result, columns, f, output_format)
+            results.append(len(result))
+        except Exception as ex:
+            results.append(str(ex))
+    return results
+
+
+class JobRunner(object):
+    """Run the jobs of a manifest with an asyncio scheduler.  Parsing hex files,
+    writing hex files and running ELF queries happen in a pool of worker
+    processes.  Every hex file is parsed only once, even if many jobs use it,
+    and a hex job that uses the output of an earlier job waits for its image
+    instead of reading the file.  The queries of every job on the same ELF file
+    run in one worker so the ELF file is only loaded once.
+    """
+
+    def __init__(self, executor, cache_dir=None, cache_size=CACHE_SIZE*1024*1024):
+        self.executor = executor
+        self.cache_dir = cache_dir
+        self.cache_size = cache_size
+        # Futures of the parsed image of each hex file, and of the image built
+        # by each hex job (by output file).
+        self.images = {}
+        self.outputs = {}
+        # Futures of the images that later jobs use.
+        self.consumed = set()
+        self.failed = 0
+
+    def _in_worker(self, function, *args):
+        """Run a function in the worker pool and return its future."""
+        return asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    async def _image(self, path, built=None):
+        """Return the parsed image of a hex file, from the future of the job
+        that builds it if there is one or else parsed from disk.
+        """
+        if built is not None:
+            image = await built
+            if image is None:
+                raise click.ClickException('input {0} failed to build'.format(path))
+            return image
+        if path not in self.images:
+            self.images[path] = self._in_worker(parse_hex, path, self.cache_dir, self.cache_size)
+        return await self.images[path]
+
+    def _report(self, name, start, error=None, rows=None):
+        """Print the outcome of a job."""
+        if error is not None:
+            self.failed += 1
+            click.echo('{0}: FAILED: {1}'.format(name, error), err=True)
+        elif rows is not None:
+            click.echo('{0}: {1} rows in {2:.3f} seconds'.format(name, rows, time.time() - start), err=True)
+        else:
+            click.echo('{0}: done in {1:.3f} seconds'.format(name, time.time() - start), err=True)
+
+    async def _run_hex_job(self, job, sources, built):
+        """Run a hexmerge or hexpad job and publish its image to later jobs.
+        Sources has the future of the earlier job that builds each input (or
+        None if it's read from disk).
+        """
+        start = time.time()
+        image = None
+        try:
+            inputs = job['inputs'] if job['command'] == 'hexmerge' else [job['input']]
+            images = await asyncio.gather(*[self._image(path, source)
+                                            for path, source in zip(inputs, sources)])
+            # Merging, padding and checksums run in a worker with the writing
+            # of the output so the scheduler isn't blocked by big images.
+            image = await self._in_worker(build_hex_file, job, images, built in self.consumed)
+            self._report(job['name'], start)
+        except Exception as ex:
+            self._report(job['name'], start, getattr(ex, 'message', None) or str(ex))
+        finally:
+            built.set_result(image)
+
+    async def _run_elf_jobs(self, input_file, jobs):
+        """Run every elfquery job of one ELF file in a single worker."""
+        start = time.time()
+        queries = [(job['query'], job['output'], job.get('output_format', 'csv')) for job in jobs]
+        results = await self._in_worker(run_queries, input_file, queries)
+        for job, result in zip(jobs, results):
+            if isinstance(result, int):
+                self._report(job['name'], start, rows=result)
+            else:
+                self._report(job['name'], start, result)
+
+    async def run(self, jobs):
+        """Run a list of jobs (from load_manifest) and return the number of
+        jobs that failed.
+        """
+        loop = asyncio.get_running_loop()
+        tasks = []
+        elf_jobs = {}
+        for job in jobs:
+            if job['command'] == 'elfquery':
+                elf_jobs.setdefault(job['input'], []).append(job)
+                continue
+            # Inputs are taken from the last earlier job that builds them, so
+            # jobs never wait on each other in a cycle.
+            inputs = job['inputs'] if job['command'] == 'hexmerge' else [job['input']]
+            sources = [self.outputs.get(path) for path in inputs]
+            self.consumed.update(source for source in sources if source is not None)
+            built = loop.create_future()
+            self.outputs[job['output']] = built
+            tasks.append(self._run_hex_job(job, sources, built))
+        for input_file, group in elf_jobs.items():
+            tasks.append(self._run_elf_jobs(input_file, group))
+        await asyncio.gather(*tasks)
+        return self.failed
+
+
+@main.command(short_help='run many hexmerge, hexpad and elfquery jobs from a manifest')
+# Take the manifest file path as input.
+@click.argument('manifest',
+                metavar='MANIFEST',
+                type=click.Path(exists=True, dir_okay=False))
+# Add option to pick how many worker processes run the jobs.
+@click.option('--jobs', '-j', 'workers',
+              type=click.IntRange(1, None),
+              default=None,
+              help='number of worker processes (defaults to the number of CPUs)')
+# Add options to control the cache of parsed hex files.
+@cache_options
+def jobs(manifest, workers, cache_dir, cache_size, no_cache):
+    """Run many hexmerge, hexpad and elfquery jobs from a manifest.
+
+    The manifest is a JSON file (or a YAML file with a .yaml or .yml extension,
+    if the PyYAML module is installed) with a list of jobs.  Each job has a
+    command and the options of that command, named like the command line
+    options.  For example:
+
+    \b
+      jobs:
+        - name: board-a
+          command: hexmerge
+          inputs: [boot.hex, build/board-a/app.hex]
+          output: out/board-a.hex
+        - command: hexpad
+          input: out/board-a.hex
+          output: out/board-a-padded.hex
+          end: 0x3FFFF
+          checksum: crc32
+          checksum-address: 0x3FFFC
+        - command: elfquery
+          input: build/board-a/app.elf
+          query: SELECT Section, Size FROM section_totals
+          output: out/board-a-footprint.csv
+          output-format: csv
+
+    Hex jobs take inputs and elfquery jobs take an input file, and every job
+    needs an output file.  Paths are relative to the manifest.  The output
+    format of elfquery jobs defaults to csv.
+
+    Jobs run concurrently in one process with a pool of worker processes.
+    Every input hex file (like a bootloader shared by all boards) is parsed only
+    once, a job that uses the output of an earlier job uses its image directly,
+    and all the queries of an ELF file run on a single load of it.  The command
+    exits with a non-zero status if any job failed.
+    """
+    job_list = load_manifest(manifest)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        runner = JobRunner(executor, None if no_cache else cache_dir, cache_size*1024*1024)
+        start = time.time()
+        failed = asyncio.run(runner.run(job_list))
+    click.echo('Ran {0} job(s) in {1:.3f} seconds, {2} failed.'.format(
+               len(job_list), time.time() - start, failed), err=True)
+    if failed:
+        raise click.ClickException('{0} job(s) failed!'.format(failed))
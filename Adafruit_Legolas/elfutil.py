@@ -0,0 +1,435 @@
+# ELF helper functions.
+#
+# Shared code for the commands that read ELF files.  Files are memory mapped so
+# section data can be read without copying, and symbol tables are decoded by
+# unpacking the raw symbol array in bulk instead of building a pyelftools object
+# for every single symbol.
+#
+# Author: Tony DiCola
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Adafruit Industries
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import hashlib
+import io
+import mmap
+import os
+import struct
+import subprocess
+
+from elftools.common.py3compat import bytes2str
+from elftools.elf.descriptions import *
+from elftools.elf.constants import SH_FLAGS
+from elftools.elf.sections import StringTableSection
+
+
+# Raw layout of the Elf32_Sym and Elf64_Sym structures (without the endianness
+# prefix).  Note the fields are in a different order for each ELF class:
+#   Elf32_Sym: st_name, st_value, st_size, st_info, st_other, st_shndx
+#   Elf64_Sym: st_name, st_info, st_other, st_shndx, st_value, st_size
+ELF32_SYM_FORMAT = 'IIIBBH'
+ELF64_SYM_FORMAT = 'IBBHQQ'
+
+# Section flag for compressed section data (SHF_COMPRESSED).
+SHF_COMPRESSED = 0x800
+
+# Magic values at the start of ar archives (thin archives only reference their
+# members by path and aren't supported).
+AR_MAGIC = b'!<arch>\n'
+AR_THIN_MAGIC = b'!<thin>\n'
+
+# Layout of an ar archive member header: name, date, uid, gid, mode, size and
+# a two byte terminator.
+AR_HEADER = struct.Struct('16s12s6s6s8s10s2s')
+
+# Names of ar archive members that hold symbol lookup tables.
+AR_SYMBOL_TABLES = ('/', '/SYM64/', '__.SYMDEF', '__.SYMDEF SORTED')
+
+# Directory that holds every cache of legolas (following the XDG base directory
+# specification).
+CACHE_ROOT = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')),
+                          'legolas')
+
+# Default program used to demangle C++ symbol names, and the location of the
+# persistent cache of demangled names.
+DEMANGLER = 'c++filt'
+DEMANGLE_CACHE = os.path.join(CACHE_ROOT, 'demangle.sqlite')
+
+# Symbol description tables (types, bindings, visibilities and section indexes)
+# of each kind of ELF file, keyed by ELF class, endianness and machine, so every
+# object of an archive doesn't build them again.
+_description_tables = {}
+
+# File extensions of object files picked up from a directory.
+OBJECT_EXTENSIONS = ('.o', '.obj')
+ARCHIVE_EXTENSIONS = ('.a', '.lib')
+
+
+class MappedFile(object):
+    """Read-only memory map of an input file.  The data attribute supports the
+    bytes-like find and slice operations (without reading the whole file), view
+    is a memoryview of the entire file for zero-copy slices, and stream is a
+    seekable file-like object suitable for pyelftools.  Files that can't be
+    memory mapped (like empty files or pipes) are read into memory instead,
+    and bytes-like data (like the member of an archive) is copied into
+    memory.
+    """
+
+    def __init__(self, input_file):
+        # Accept a path, an already open binary file object, or data.
+        if isinstance(input_file, (bytes, bytearray, memoryview)):
+            self.name = None
+            self._mmap = None
+            data = bytes(input_file)
+        elif hasattr(input_file, 'read'):
+            self.name = getattr(input_file, 'name', None)
+            self._mmap = self._map(input_file)
+            if self._mmap is None:
+                data = input_file.read()
+        else:
+            self.name = input_file
+            with open(input_file, 'rb') as f:
+                self._mmap = self._map(f)
+                if self._mmap is None:
+                    data = f.read()
+        if self._mmap is not None:
+            self.data = self._mmap
+            self.stream = self._mmap
+        else:
+            self.data = data
+            self.stream = io.BytesIO(data)
+        self.view = memoryview(self.data)
+
+    def _map(self, f):
+        """Memory map the provided file object, or return None if it can't be
+        mapped.
+        """
+        try:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, ValueError, EnvironmentError, io.UnsupportedOperation):
+            return None
+
+    def slice(self, offset, size):
+        """Return a memoryview of size bytes starting at offset, no data is
+        copied.
+        """
+        return self.view[offset:offset+size]
+
+    def close(self):
+        """Release the view and unmap the file."""
+        self.view.release()
+        if self._mmap is not None:
+            self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class SymbolDecoder(object):
+    """Decode symbol table sections of an ELF file into tuples of symbol
+    values.  The raw symbol array is unpacked in bulk with the struct module,
+    names are looked up directly in the string table data, and the type,
+    binding, visibility and section index descriptions come from tables that
+    are computed once for each kind (class, endianness and machine) of ELF
+    file.  Symbol tables with an unusual layout fall back
+    to decoding each symbol with pyelftools.
+
+    If the MappedFile of the ELF file is provided symbols and names are read
+    straight from the mapped file without copying the section contents.
+    """
+
+    def __init__(self, elffile, mapped=None):
+        self.elffile = elffile
+        self.mapped = mapped
+        prefix = '<' if elffile.little_endian else '>'
+        if elffile.elfclass == 32:
+            self._struct = struct.Struct(prefix + ELF32_SYM_FORMAT)
+        else:
+            self._struct = struct.Struct(prefix + ELF64_SYM_FORMAT)
+        key = (elffile.elfclass, elffile.little_endian, elffile['e_machine'])
+        tables = _description_tables.get(key)
+        if tables is None:
+            tables = self._build_tables()
+            _description_tables[key] = tables
+        self._types, self._binds, self._visibilities, self._shndxs = tables
+
+    def _build_tables(self):
+        """Return the type, binding and visibility description tables and the
+        (initially empty) dict of section index descriptions.
+        """
+        # Build the description tables by letting pyelftools parse a synthetic
+        # symbol for every possible st_info and st_other value.  This guarantees
+        # the descriptions match what the pyelftools fallback would produce.
+        types = []
+        binds = []
+        visibilities = []
+        for code in range(256):
+            symbol = self._parse_synthetic(info=code, other=code)
+            types.append(describe_symbol_type(symbol['st_info']['type']).strip())
+            binds.append(describe_symbol_bind(symbol['st_info']['bind']).strip())
+            visibilities.append(describe_symbol_visibility(symbol['st_other']['visibility']).strip())
+        # Section index descriptions are filled in as new values are seen since
+        # there are too many possible values to compute up front.
+        return (types, binds, visibilities, {})
+
+    def _parse_synthetic(self, info=0, other=0, shndx=0):
+        """Parse a symbol with the provided field values using pyelftools."""
+        if self.elffile.elfclass == 32:
+            data = self._struct.pack(0, 0, 0, info, other, shndx)
+        else:
+            data = self._struct.pack(0, info, other, shndx, 0, 0)
+        return self.elffile.structs.Elf_Sym.parse(data)
+
+    def _describe_shndx(self, shndx):
+        """Return the description of a raw section index value."""
+        description = self._shndxs.get(shndx)
+        if description is None:
+            symbol = self._parse_synthetic(shndx=shndx)
+            description = describe_symbol_shndx(symbol['st_shndx']).strip()
+            self._shndxs[shndx] = description
+        return description
+
+    def _can_decode(self, section):
+        """Return True if the symbol table section can be decoded in bulk."""
+        if section['sh_type'] == 'SHT_NOBITS':
+            return False
+        if section['sh_flags'] & SHF_COMPRESSED:
+            return False
+        if section['sh_entsize'] != self._struct.size:
+            return False
+        if section['sh_size'] % self._struct.size != 0:
+            return False
+        return isinstance(getattr(section, 'stringtable', None), StringTableSection)
+
+    def iter_symbols(self, section):
+        """Yield a tuple of (value, size, type, binding, visibility, section
+        index, name) for each symbol in the provided symbol table section.
+        """
+        if not self._can_decode(section):
+            for symbol in self._iter_symbols_slow(section):
+                yield symbol
+            return
+        if self.mapped is not None:
+            # Unpack symbols from a view of the file and search for names
+            # inside the file data using offsets from the string table start.
+            data = self.mapped.slice(section['sh_offset'], section['sh_size'])
+            strtab = self.mapped.data
+            strtab_start = section.stringtable['sh_offset']
+            strtab_end = strtab_start + section.stringtable['sh_size']
+        else:
+            data = section.data()
+            strtab = section.stringtable.data()
+            strtab_start = 0
+            strtab_end = len(strtab)
+        entries = self._struct.iter_unpack(data)
+        if self.elffile.elfclass == 64:
+            # Reorder the fields to match the Elf32_Sym layout.
+            entries = ((name, value, size, info, other, shndx)
+                       for name, info, other, shndx, value, size in entries)
+        types = self._types
+        binds = self._binds
+        visibilities = self._visibilities
+        shndxs = self._shndxs
+        for st_name, value, size, info, other, shndx in entries:
+            # Names are NULL terminated strings inside the string table.
+            start = strtab_start + st_name
+            end = strtab.find(b'\0', start, strtab_end)
+            if end < 0:
+                end = strtab_end
+            shndx_description = shndxs.get(shndx)
+            if shndx_description is None:
+                shndx_description = self._describe_shndx(shndx)
+            yield (value,
+                   size,
+                   types[info],
+                   binds[info],
+                   visibilities[other],
+                   shndx_description,
+                   bytes2str(strtab[start:end]).strip())
+
+    def _iter_symbols_slow(self, section):
+        """Decode each symbol with pyelftools, used for unusual symbol table
+        layouts.  Adapted from readelf.py.
+        """
+        for symbol in section.iter_symbols():
+            yield (symbol['st_value'],
+                   symbol['st_size'],
+                   describe_symbol_type(symbol['st_info']['type']).strip(),
+                   describe_symbol_bind(symbol['st_info']['bind']).strip(),
+                   describe_symbol_visibility(symbol['st_other']['visibility']).strip(),
+                   describe_symbol_shndx(symbol['st_shndx']).strip(),
+                   bytes2str(symbol.name).strip())
+
+
+def section_digests(elffile, mapped):
+    """Return a list with a tuple of (name, raw header bytes, content digest)
+    for each section of the provided ELF file and its MappedFile.  Contents are
+    hashed straight from the mapped file and sections without data in the file
+    (like .bss) have a digest of None.  Comparing these lists is a cheap way to
+    find which sections changed between two builds.
+    """
+    digests = []
+    header_offset = elffile['e_shoff']
+    header_size = elffile['e_shentsize']
+    for nsec, section in enumerate(elffile.iter_sections()):
+        header = mapped.slice(header_offset + nsec*header_size, header_size).tobytes()
+        if section['sh_type'] == 'SHT_NOBITS':
+            digest = None
+        else:
+            content = mapped.slice(section['sh_offset'], section['sh_size'])
+            digest = hashlib.sha1(content).digest()
+            content.release()
+        digests.append((bytes2str(section.name).strip(), header, digest))
+    return digests
+
+
+def load_segments(elffile, mapped, physical=True):
+    """Return a list of (segment number, address, memoryview) tuples with the
+    contents in the file of each PT_LOAD segment, at its physical (load)
+    address or its virtual address.  Like objcopy only the parts of a segment
+    that hold allocated sections are included (not the ELF header or padding
+    between sections), unless the file has no section headers.  Memory that
+    isn't in the file (like .bss) is not included.
+    """
+    sections = [(section['sh_offset'], section['sh_size'])
+                for section in elffile.iter_sections()
+                if section['sh_flags'] & SH_FLAGS.SHF_ALLOC and
+                   section['sh_type'] != 'SHT_NOBITS' and section['sh_size'] > 0]
+    sections.sort()
+    segments = []
+    for nseg, segment in enumerate(elffile.iter_segments()):
+        if segment['p_type'] != 'PT_LOAD' or segment['p_filesz'] == 0:
+            continue
+        address = segment['p_paddr'] if physical else segment['p_vaddr']
+        start = segment['p_offset']
+        end = start + segment['p_filesz']
+        if elffile.num_sections() == 0:
+            segments.append((nseg, address, mapped.slice(start, end - start)))
+            continue
+        for offset, size in sections:
+            if offset >= start and offset + size <= end:
+                segments.append((nseg, address + offset - start, mapped.slice(offset, size)))
+    return segments
+
+
+def iter_archive_members(data):
+    """Yield a tuple of (name, offset, size) for each file in the data of an ar
+    archive (like a static library).  Both the GNU and BSD variants of long
+    member names are supported and the symbol tables are skipped.
+    """
+    if data[:len(AR_THIN_MAGIC)] == AR_THIN_MAGIC:
+        raise ValueError('Thin archives are not supported.')
+    if data[:len(AR_MAGIC)] != AR_MAGIC:
+        raise ValueError('Not an ar archive.')
+    offset = len(AR_MAGIC)
+    long_names = b''
+    while offset + AR_HEADER.size <= len(data):
+        name, date, uid, gid, mode, size, end = AR_HEADER.unpack_from(data, offset)
+        if end != b'`\n':
+            raise ValueError('Malformed archive member header at offset {0}.'.format(offset))
+        size = int(size.strip())
+        start = offset + AR_HEADER.size
+        # Members are aligned to an even offset.
+        offset = start + size + (size & 1)
+        name = name.rstrip(b' ')
+        if bytes2str(name) in AR_SYMBOL_TABLES:
+            # Check the raw name, the GNU 64-bit symbol table (/SYM64/) would
+            # otherwise look like a short name.
+            continue
+        if name == b'//':
+            # GNU table of long member names.
+            long_names = data[start:start+size]
+            continue
+        if name.startswith(b'#1/'):
+            # BSD long name which is stored right before the member data.
+            length = int(name[3:])
+            name = data[start:start+length].rstrip(b'\0')
+            start += length
+            size -= length
+        elif name.startswith(b'/') and name[1:].isdigit():
+            # GNU long name, an offset into the long name table.
+            index = int(name[1:])
+            name = long_names[index:long_names.find(b'/\n', index)]
+        elif name.endswith(b'/') and name != b'/':
+            # GNU short names end with a slash.
+            name = name[:-1]
+        name = bytes2str(name)
+        if name in AR_SYMBOL_TABLES:
+            continue
+        yield (name, start, size)
+
+
+def find_objects(path):
+    """Find the object files to load for a path.  Returns None if the path is a
+    single file that isn't an archive.  For an archive or a directory (which is
+    searched recursively for object files and archives) a list of tuples of
+    (archive, member, file path, offset, size) is returned.  Archive members
+    have the archive path and member name, offset and size of the member in the
+    archive.  Object files in a directory have no archive, their path relative
+    to the directory as the member name, and an offset of 0 and size of None.
+    """
+    if os.path.isdir(path):
+        objects = []
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                filename = os.path.join(root, name)
+                extension = os.path.splitext(name)[1].lower()
+                if extension in OBJECT_EXTENSIONS:
+                    objects.append((None, os.path.relpath(filename, path), filename, 0, None))
+                elif extension in ARCHIVE_EXTENSIONS:
+                    objects.extend(_archive_objects(filename))
+        return objects
+    with open(path, 'rb') as f:
+        magic = f.read(len(AR_MAGIC))
+    if magic in (AR_MAGIC, AR_THIN_MAGIC):
+        return _archive_objects(path)
+    return None
+
+
+def _archive_objects(path):
+    """Return the object tuples (see find_objects) for an archive."""
+    with MappedFile(path) as mapped:
+        return [(path, name, path, offset, size)
+                for name, offset, size in iter_archive_members(mapped.data)]
+
+
+def demangle(names, program=DEMANGLER):
+    """Demangle a list of C++ symbol names with a single run of the c++filt
+    program (or a compatible one) and return the list of demangled names.
+    Returns None if the program isn't available or fails.
+    """
+    if not names:
+        return []
+    try:
+        process = subprocess.Popen([program], stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError:
+        return None
+    data = '\n'.join(names).encode('latin-1') + b'\n'
+    output, errors = process.communicate(data)
+    demangled = output.decode('latin-1').splitlines()
+    if process.returncode != 0 or len(demangled) != len(names):
+        return None
+    return demangled
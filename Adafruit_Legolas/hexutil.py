@@ -0,0 +1,593 @@
+# Intel hex helper functions.
+#
+# Shared code for the commands that work with Intel format hex files.  Images
+# are handled as a sorted list of (start address, data) segments so operations
+# like checksums can run over large blocks of data and fold in the gaps between
+# segments without building the full padded image in memory.  Parsed images can
+# also be kept in an on-disk cache of segment data which is memory mapped when
+# the same hex file is used again.
+#
+# Author: Tony DiCola
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Adafruit Industries
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import binascii
+import bisect
+import hashlib
+import mmap
+import os
+import re
+import struct
+import tempfile
+import zlib
+
+import click
+import intelhex
+
+from .elfutil import CACHE_ROOT
+
+
+# Size of the blocks that runs of padding are generated in.
+BLOCK_SIZE = 64*1024
+
+# Checksum algorithms that can be computed over an image.
+CHECKSUM_ALGORITHMS = ['crc16', 'crc32', 'sha256']
+
+# Matches each run of differing bytes in the XOR of two blocks of data.
+DIFF_RUN = re.compile(b'[^\x00]+')
+
+# Default location and size limit (in megabytes) of the parsed image cache.
+CACHE_DIR = os.path.join(CACHE_ROOT, 'hex')
+CACHE_SIZE = 256
+
+# Layout of a cached image file.  A header with a magic value, the kind of start
+# address (0 = none, 1 = CS & IP, 2 = EIP), the start address values and the
+# segment count is followed by the address and length of each segment, then the
+# data of all the segments.
+CACHE_MAGIC = b'LHX1'
+CACHE_HEADER = struct.Struct('<4sB3xIII')
+CACHE_SEGMENT = struct.Struct('<QQ')
+
+
+def image_segments(ih):
+    """Return a sorted list of (start address, data bytes) tuples for each
+    contiguous range of data in the provided IntelHex object.
+    """
+    return [(start, ih.tobinstr(start=start, end=end-1))
+            for start, end in ih.segments()]
+
+
+def read_hex(filename):
+    """Parse an Intel hex file and return a tuple of its sorted list of segments
+    and start address (a dict like IntelHex.start_addr, or None).
+    """
+    ih = intelhex.IntelHex(filename)
+    return (image_segments(ih), ih.start_addr)
+
+
+def merge_segments(segments, other, overlap='error'):
+    """Merge the other sorted list of segments into a copy of segments and
+    return it.  Overlapping data is handled like IntelHex.merge: error raises
+    intelhex.AddressOverlapError, ignore keeps the existing data, and replace
+    uses the other data.  Data is sliced with memoryviews and not copied.
+    """
+    merged = list(segments)
+    for start, data in other:
+        end = start + len(data)
+        # Find the existing segments that overlap this one.
+        starts = [segment[0] for segment in merged]
+        first = bisect.bisect_right(starts, start)
+        if first > 0 and merged[first-1][0] + len(merged[first-1][1]) > start:
+            first -= 1
+        last = bisect.bisect_left(starts, end)
+        overlapped = merged[first:last]
+        if not overlapped:
+            merged.insert(first, (start, data))
+            continue
+        if overlap == 'error':
+            raise intelhex.AddressOverlapError('Data overlapped at address 0x{0:X}'.format(
+                                               max(start, overlapped[0][0])))
+        view = memoryview(data)
+        pieces = []
+        if overlap == 'ignore':
+            # Keep the existing segments and fill the holes between them.
+            address = start
+            for segment_start, segment_data in overlapped:
+                if segment_start > address:
+                    pieces.append((address, view[address-start:segment_start-start]))
+                pieces.append((segment_start, segment_data))
+                address = max(address, segment_start + len(segment_data))
+            if address < end:
+                pieces.append((address, view[address-start:]))
+        else:
+            # Keep the parts of existing segments outside the new segment.
+            head_start, head_data = overlapped[0]
+            if head_start < start:
+                pieces.append((head_start, memoryview(head_data)[:start-head_start]))
+            pieces.append((start, data))
+            tail_start, tail_data = overlapped[-1]
+            if tail_start + len(tail_data) > end:
+                pieces.append((end, memoryview(tail_data)[end-tail_start:]))
+        merged[first:last] = pieces
+    return merged
+
+
+def merge_start_addr(start_addr, other, overlap='error'):
+    """Merge two start addresses like IntelHex.merge and return the result."""
+    if start_addr == other or other is None:
+        return start_addr
+    if start_addr is None:
+        return other
+    if overlap == 'error':
+        raise intelhex.AddressOverlapError('Starting addresses are different')
+    elif overlap == 'replace':
+        return other
+    return start_addr
+
+
+def _split_blocks(segments, block_size):
+    """Yield segments split (as memoryview slices) at every multiple of the
+    block size.
+    """
+    for start, data in segments:
+        end = start + len(data)
+        if end <= start:
+            continue
+        if start // block_size == (end - 1) // block_size:
+            yield (start, data)
+            continue
+        view = memoryview(data)
+        address = start
+        while address < end:
+            stop = min((address // block_size + 1)*block_size, end)
+            yield (address, view[address-start:stop-start])
+            address = stop
+
+
+def iter_runs(segments, block_size=None):
+    """Yield (start address, data) for each run of contiguous data, joining
+    segments that are right next to each other.  If a block size is provided
+    runs are also split at every multiple of it, so at most one block of data
+    is joined in memory.
+    """
+    if block_size is not None:
+        segments = _split_blocks(segments, block_size)
+    run_start = None
+    run_end = None
+    pieces = []
+    for start, data in segments:
+        if pieces and (start != run_end or (block_size is not None and start % block_size == 0)):
+            yield (run_start, pieces[0] if len(pieces) == 1 else b''.join(pieces))
+            pieces = []
+        if not pieces:
+            run_start = start
+        pieces.append(data)
+        run_end = start + len(data)
+    if pieces:
+        yield (run_start, pieces[0] if len(pieces) == 1 else b''.join(pieces))
+
+
+def iter_padded(segments, start, end, pad):
+    """Yield the sorted segments of an image with the gaps between them from
+    start to end (inclusive) filled with runs of the pad byte.  Padding is
+    generated in blocks of at most BLOCK_SIZE bytes (aligned to BLOCK_SIZE) as
+    it's needed, so the padded image is never held in memory.  Segments outside
+    the range are kept as they are.
+    """
+    pad_block = bytes(bytearray([pad & 0xFF]))*BLOCK_SIZE
+    address = start
+    stop = end + 1
+    for segment_start, data in segments:
+        # Fill the gap before the segment.
+        gap_end = min(segment_start, stop)
+        while address < gap_end:
+            size = min(gap_end - address, BLOCK_SIZE - address % BLOCK_SIZE)
+            yield (address, pad_block[:size])
+            address += size
+        yield (segment_start, data)
+        address = max(address, segment_start + len(data))
+    # Fill the gap after the last segment.
+    while address < stop:
+        size = min(stop - address, BLOCK_SIZE - address % BLOCK_SIZE)
+        yield (address, pad_block[:size])
+        address += size
+
+
+def _hex_record(address, record_type, data):
+    """Return an Intel hex record line for the provided address, type and data."""
+    record = bytearray(struct.pack('>BHB', len(data), address & 0xFFFF, record_type))
+    record.extend(data)
+    record.append((-sum(record)) & 0xFF)
+    return ':' + binascii.hexlify(bytes(record)).decode('ascii').upper() + '\n'
+
+
+def _data_records(start, data):
+    """Return the list of Intel hex data records for a run of data that doesn't
+    cross a 64KB boundary.
+    """
+    view = memoryview(data)
+    records = []
+    for offset in range(0, len(data), 16):
+        records.append(_hex_record(start + offset, 0, view[offset:offset+16].tobytes()))
+    return records
+
+
+def write_hex(segments, start_addr, output, write_start_addr=True, max_address=None):
+    """Write a sorted list of segments and start address to output (a path or
+    file object) in Intel hex format.  The output matches what
+    IntelHex.write_hex_file writes for the same data: 16 byte data records that
+    never cross a 64KB boundary, with extended linear address records when data
+    is above 64KB.
+
+    Segments can also be any iterable of sorted segments (like iter_padded
+    generates) if the largest address of the data is provided as max_address,
+    only one 64KB block of data is held in memory at a time.
+    """
+    if max_address is None:
+        max_address = segments[-1][0] + len(segments[-1][1]) - 1 if segments else -1
+    close = False
+    if not hasattr(output, 'write'):
+        output = open(output, 'w')
+        close = True
+    try:
+        if start_addr and write_start_addr:
+            keys = sorted(start_addr.keys())
+            if keys == ['CS', 'IP']:
+                output.write(_hex_record(0, 3, struct.pack('>HH', start_addr['CS'], start_addr['IP'])))
+            elif keys == ['EIP']:
+                output.write(_hex_record(0, 5, struct.pack('>I', start_addr['EIP'])))
+            else:
+                raise intelhex.InvalidStartAddressValueError(start_addr=start_addr)
+        # Extended linear address records are only used if data is above 64KB.
+        need_offset = max_address > 0xFFFF
+        high = None
+        lines = []
+        # Records of the last full 64KB block, a block with the same data (like
+        # a block of padding) has the same records.
+        repeated = None
+        # Runs are split at 64KB boundaries, records never cross them so each
+        # run is written on its own.
+        for start, data in iter_runs(segments, 0x10000):
+            if need_offset and start >> 16 != high:
+                high = start >> 16
+                lines.append(_hex_record(0, 4, struct.pack('>H', high)))
+            if len(data) == 0x10000:
+                block = memoryview(data).tobytes()
+                if repeated is None or repeated[0] != block:
+                    repeated = (block, ''.join(_data_records(start, block)))
+                output.write(''.join(lines))
+                output.write(repeated[1])
+                lines = []
+                continue
+            lines.extend(_data_records(start, data))
+            # Write lines in large chunks.
+            if len(lines) >= 4096:
+                output.write(''.join(lines))
+                lines = []
+        lines.append(':00000001FF\n')
+        output.write(''.join(lines))
+    finally:
+        if close:
+            output.close()
+
+
+class HexCache(object):
+    """On-disk cache of parsed hex files.  Entries are named by the SHA-256 of
+    the hex file contents and hold its segments and start address in a compact
+    binary form.  Cached entries are memory mapped so their segment data isn't
+    read until it's used.  When the cache grows past its size limit (in bytes)
+    the least recently used entries are removed.
+    """
+
+    def __init__(self, directory=CACHE_DIR, max_size=CACHE_SIZE*1024*1024):
+        self.directory = directory
+        self.max_size = max_size
+
+    def load(self, filename):
+        """Return a tuple of the sorted list of segments and start address of
+        a hex file, from the cache if possible.
+        """
+        with open(filename, 'rb') as f:
+            key = hashlib.sha256(f.read()).hexdigest()
+        path = os.path.join(self.directory, key + '.seg')
+        try:
+            image = self._read(path)
+        except (EnvironmentError, ValueError, struct.error):
+            image = None
+        if image is not None:
+            # Mark the entry as recently used.
+            os.utime(path, None)
+            return image
+        segments, start_addr = read_hex(filename)
+        try:
+            self._write(path, segments, start_addr)
+            self._evict()
+        except EnvironmentError:
+            # The cache is only an optimization, ignore failures to write it.
+            pass
+        return (segments, start_addr)
+
+    def _read(self, path):
+        """Memory map a cached image and return its segments (as memoryviews
+        of the map) and start address, or None if it isn't valid.
+        """
+        with open(path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, kind, value1, value2, count = CACHE_HEADER.unpack_from(data, 0)
+        if magic != CACHE_MAGIC:
+            return None
+        if kind == 1:
+            start_addr = {'CS': value1, 'IP': value2}
+        elif kind == 2:
+            start_addr = {'EIP': value1}
+        else:
+            start_addr = None
+        view = memoryview(data)
+        segments = []
+        offset = CACHE_HEADER.size + count*CACHE_SEGMENT.size
+        for i in range(count):
+            address, length = CACHE_SEGMENT.unpack_from(data, CACHE_HEADER.size + i*CACHE_SEGMENT.size)
+            segments.append((address, view[offset:offset+length]))
+            offset += length
+        if offset != len(data):
+            return None
+        return (segments, start_addr)
+
+    def _write(self, path, segments, start_addr):
+        """Write an image to the cache (atomically so concurrent builds never
+        see a partial entry).
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        if start_addr is None:
+            header = CACHE_HEADER.pack(CACHE_MAGIC, 0, 0, 0, len(segments))
+        elif 'EIP' in start_addr:
+            header = CACHE_HEADER.pack(CACHE_MAGIC, 2, start_addr['EIP'], 0, len(segments))
+        else:
+            header = CACHE_HEADER.pack(CACHE_MAGIC, 1, start_addr['CS'], start_addr['IP'], len(segments))
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(header)
+                for address, data in segments:
+                    f.write(CACHE_SEGMENT.pack(address, len(data)))
+                for address, data in segments:
+                    f.write(data)
+            os.replace(temp_path, path)
+        except:
+            os.remove(temp_path)
+            raise
+
+    def _evict(self):
+        """Remove the least recently used entries until the cache is within its
+        size limit.
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.seg'):
+                continue
+            stat = os.stat(os.path.join(self.directory, name))
+            entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(entry[1] for entry in entries)
+        for mtime, size, name in sorted(entries):
+            if total <= self.max_size:
+                break
+            os.remove(os.path.join(self.directory, name))
+            total -= size
+
+
+def iter_image_blocks(segments, start, end, fill):
+    """Yield blocks of bytes for every address from start to end (inclusive) of
+    the image made up of the sorted list of segments.  Gaps between segments
+    are filled with the fill byte and yielded in blocks of at most BLOCK_SIZE
+    bytes so the padded image is never built in memory.
+    """
+    pad_block = bytes(bytearray([fill & 0xFF]))*BLOCK_SIZE
+    address = start
+    stop = end + 1
+    for segment_start, data in segments:
+        segment_end = segment_start + len(data)
+        if segment_end <= address:
+            continue
+        if segment_start >= stop:
+            break
+        # Fill the gap before the segment.
+        while address < segment_start:
+            size = min(segment_start - address, BLOCK_SIZE)
+            yield pad_block[:size]
+            address += size
+        # Yield the part of the segment inside the range without copying it.
+        view_end = min(segment_end, stop)
+        yield memoryview(data)[address-segment_start:view_end-segment_start]
+        address = view_end
+    # Fill the gap after the last segment.
+    while address < stop:
+        size = min(stop - address, BLOCK_SIZE)
+        yield pad_block[:size]
+        address += size
+
+
+def compute_checksum(algorithm, blocks):
+    """Compute the checksum of a sequence of blocks of bytes.  Returns the
+    checksum as bytes in big endian (most significant byte first) order, like
+    a hashlib digest.  The supported algorithms are:
+      - crc16: CRC-16/CCITT-FALSE (polynomial 0x1021, initial value 0xFFFF)
+      - crc32: CRC-32 as computed by zlib (and Ethernet, PNG, etc.)
+      - sha256: SHA-256 digest
+    """
+    if algorithm == 'crc16':
+        crc = 0xFFFF
+        for block in blocks:
+            crc = binascii.crc_hqx(block, crc)
+        return struct.pack('>H', crc)
+    elif algorithm == 'crc32':
+        crc = 0
+        for block in blocks:
+            crc = zlib.crc32(block, crc)
+        return struct.pack('>I', crc & 0xFFFFFFFF)
+    elif algorithm == 'sha256':
+        digest = hashlib.sha256()
+        for block in blocks:
+            digest.update(block)
+        return digest.digest()
+    else:
+        raise ValueError('Unknown checksum algorithm: {0}'.format(algorithm))
+
+
+def checksum_options(command):
+    """Decorator to add the checksum options to a click command."""
+    # Import here to avoid a circular import, main loads all the commands.
+    from .main import HexInt
+    options = [
+        click.option('--checksum',
+                     type=click.Choice(CHECKSUM_ALGORITHMS),
+                     default=None,
+                     help='compute a checksum of the output image.  Can be crc16 (CCITT-FALSE), crc32, or sha256.  ' \
+                          'The checksum is printed to standard error.'),
+        click.option('--checksum-start',
+                     type=HexInt(),
+                     default=None,
+                     metavar='ADDRESS (supports hex with 0x, like 0xFFFF)',
+                     help='first address included in the checksum.  Defaults to the start of the output image.'),
+        click.option('--checksum-end',
+                     type=HexInt(),
+                     default=None,
+                     metavar='ADDRESS (supports hex with 0x, like 0xFFFF)',
+                     help='last address included in the checksum.  Defaults to the end of the output image.'),
+        click.option('--checksum-fill',
+                     type=HexInt(),
+                     default=None,
+                     metavar='BYTE (supports hex with 0x, like 0xFF)',
+                     help='byte value used for unused addresses in the checksum range.  Defaults to the pad byte (0xFF).'),
+        click.option('--checksum-address',
+                     type=HexInt(),
+                     default=None,
+                     metavar='ADDRESS (supports hex with 0x, like 0xFFFF)',
+                     help='write the checksum into the output image at this address.  Must be outside the checksum range.'),
+        click.option('--checksum-endian',
+                     type=click.Choice(['little', 'big']),
+                     default='little',
+                     help='byte order of a CRC written with --checksum-address.  Defaults to little endian.')
+    ]
+    for option in reversed(options):
+        command = option(command)
+    return command
+
+
+def cache_options(command):
+    """Decorator to add the options that control the cache of parsed hex files
+    to a click command.
+    """
+    options = [
+        click.option('--cache-dir',
+                     type=click.Path(file_okay=False),
+                     default=CACHE_DIR,
+                     help='directory for the cache of parsed hex files (defaults to {0})'.format(CACHE_DIR)),
+        click.option('--cache-size',
+                     type=int,
+                     default=CACHE_SIZE,
+                     help='size limit of the cache in megabytes, least recently used files are removed beyond it (defaults to {0})'.format(CACHE_SIZE)),
+        click.option('--no-cache',
+                     is_flag=True,
+                     help='always parse the hex files and don\'t use the cache')
+    ]
+    for option in reversed(options):
+        command = option(command)
+    return command
+
+
+def apply_checksum(segments, algorithm, start, end, fill, address=None, endian='little',
+                   label=None):
+    """Compute the checksum of an image (sorted list of segments) from the start
+    to end address (inclusive) with unused addresses set to the fill byte.  The
+    checksum is printed to standard error (after the label, like a job name, if
+    one is provided) and the bytes to write into the image are returned (or
+    None if no address to write the checksum was provided).
+    """
+    if start < 0 or end < start:
+        raise click.ClickException('Checksum end address must be after start address!')
+    checksum = compute_checksum(algorithm, iter_image_blocks(segments, start, end, fill))
+    click.echo('{0}{1} of 0x{2:08X}-0x{3:08X}: {4}'.format('' if label is None else label + ': ',
+               algorithm, start, end, binascii.hexlify(checksum).decode('ascii').upper()), err=True)
+    if address is None:
+        return None
+    if address <= end and address + len(checksum) > start:
+        raise click.ClickException('Checksum address must be outside the checksum range!')
+    if endian == 'little' and algorithm != 'sha256':
+        checksum = checksum[::-1]
+    return checksum
+
+
+def _diff_runs(expected, actual):
+    """Return (offset, length) of each run of differing bytes between two byte
+    strings of the same length.  The XOR of the two (as big integers) is zero
+    wherever they match.
+    """
+    diff = int(binascii.hexlify(expected), 16) ^ int(binascii.hexlify(actual), 16)
+    diff = binascii.unhexlify('{0:0{1}x}'.format(diff, len(expected)*2))
+    return [(match.start(), match.end() - match.start()) for match in DIFF_RUN.finditer(diff)]
+
+
+def compare_segments(expected, actual, block_size=BLOCK_SIZE):
+    """Compare two images (sorted lists of segments) and return a list of
+    (start, end, kind) tuples for each range of addresses (end is exclusive)
+    where they don't match.  The kind is 'differs' where both images have
+    different data, 'missing' where only the expected image has data, and
+    'extra' where only the actual image has data.  Data is compared a block at
+    a time and only blocks that differ are searched for the exact ranges.
+    """
+    ranges = []
+    def add(start, end, kind):
+        # Join ranges of the same kind that are right next to each other.
+        if ranges and ranges[-1][1] == start and ranges[-1][2] == kind:
+            ranges[-1] = (ranges[-1][0], end, kind)
+        else:
+            ranges.append((start, end, kind))
+    # Split the address space at every segment boundary, within each part
+    # both, one or none of the images have data.
+    points = sorted(set(point for start, data in list(expected) + list(actual)
+                        for point in (start, start + len(data))))
+    i = 0
+    j = 0
+    for start, end in zip(points, points[1:]):
+        while i < len(expected) and expected[i][0] + len(expected[i][1]) <= start:
+            i += 1
+        while j < len(actual) and actual[j][0] + len(actual[j][1]) <= start:
+            j += 1
+        has_expected = i < len(expected) and expected[i][0] <= start
+        has_actual = j < len(actual) and actual[j][0] <= start
+        if has_expected and has_actual:
+            expected_view = memoryview(expected[i][1])
+            actual_view = memoryview(actual[j][1])
+            for block_start in range(start, end, block_size):
+                block_end = min(block_start + block_size, end)
+                expected_block = expected_view[block_start-expected[i][0]:block_end-expected[i][0]].tobytes()
+                actual_block = actual_view[block_start-actual[j][0]:block_end-actual[j][0]].tobytes()
+                if expected_block == actual_block:
+                    continue
+                for offset, length in _diff_runs(expected_block, actual_block):
+                    add(block_start + offset, block_start + offset + length, 'differs')
+        elif has_expected:
+            add(start, end, 'missing')
+        elif has_actual:
+            add(start, end, 'extra')
+    return ranges
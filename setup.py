@@ -13,5 +13,6 @@ setup(name              = 'Adafruit_Legolas',
       license           = 'MIT',
       url               = 'https://github.com/adafruit/Adafruit_Legolas',
       entry_points      = {'console_scripts': ['legolas = Adafruit_Legolas.main:main']},
-      install_requires  = ['Click', 'IntelHex', 'pyelftools', 'tabulate'],
+      install_requires  = ['Click', 'IntelHex', 'pyelftools'],
+      python_requires   = '>=3.7',
       packages          = find_packages())